@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+"""
+Autocompletion of product names.
+
+Every instance keeps a PrefixIndex per network: a trie of the words of the names of the most
+popular products, where every node keeps the most popular products below it. Looking up a
+prefix is therefore a walk down the trie of at most MAX_PREFIX_LENGTH steps, regardless of the
+number of products.
+
+The index of a network is loaded from the storage backend when it's first needed, and reloaded
+after MAX_AGE seconds to pick up products created by other instances. Only a single request at a
+time loads the index of a network, while concurrent requests keep using the expired index.
+Products created or voted on by the instance itself are added right away. Until a network has
+been looked up WARM_AFTER times, lookups are answered by the storage backend instead (see
+Storage.find_products()), so instances don't load the index of every network that is only looked
+up once in a while.
+
+Names are normalized using storage.normalize_name(), the same normalization that is used to
+identify products when voting, so a suggestion always matches the existing product.
+"""
+
+import storage
+import threading
+import time
+
+
+SUGGESTIONS = 10
+
+MAX_PREFIX_LENGTH = storage.MAX_PREFIX_LENGTH
+
+MAX_PRODUCTS = 10000
+
+MAX_AGE = 600 # seconds
+
+WARM_AFTER = 3
+
+
+class PrefixIndex:
+    """
+    Trie of the words of product names.
+
+    Every node is a dictionary mapping characters to child nodes, while the empty string maps to
+    a list of the most popular products having a word starting with the prefix of the node, as
+    (-num_voters, name, normalized name) tuples. Products are identified by their normalized
+    name (see storage.normalize_name()), so votes can be added by name alone.
+
+    Additions are serialized using a lock. Lookups don't need to lock, as lists of products are
+    replaced rather than modified.
+    """
+    def __init__(self, size=SUGGESTIONS):
+        self.size = size
+        self.loaded_at = time.time()
+        self._root = {}
+        self._products = {} # normalized name -> (name, num_voters)
+        self._lock = threading.Lock()
+
+    def add(self, name, num_voters):
+        """Adds a product, or updates its number of voters."""
+        normalized_name = storage.normalize_name(name)
+        if normalized_name:
+            with self._lock:
+                self._add(normalized_name, name, num_voters)
+
+    def add_vote(self, name):
+        """Adds a vote on a product, which is added with a single voter if it isn't indexed."""
+        normalized_name = storage.normalize_name(name)
+        if normalized_name:
+            with self._lock:
+                (name, num_voters) = self._products.get(
+                    normalized_name, (name.strip()[:storage.MAX_NAME_LENGTH], 0))
+                self._add(normalized_name, name, num_voters + 1)
+
+    def _add(self, normalized_name, name, num_voters):
+        self._products[normalized_name] = (name, num_voters)
+        suggestion = (-num_voters, name, normalized_name)
+        for word in storage.word_starts(normalized_name):
+            node = self._root
+            for char in word[:MAX_PREFIX_LENGTH]:
+                node = node.setdefault(char, {})
+                products = [product for product in node.get("", [])
+                            if product[2] != normalized_name]
+                if len(products) < self.size or suggestion < products[-1]:
+                    products.append(suggestion)
+                    products.sort()
+                    node[""] = products[:self.size]
+
+    def search(self, prefix, limit=SUGGESTIONS):
+        """
+        Returns the most popular products having a word starting with the given prefix.
+
+        @return List of dictionaries with name and num_voters properties, ordered by popularity.
+        """
+        prefix = storage.normalize_name(prefix)
+        if not prefix:
+            return []
+
+        node = self._root
+        for char in prefix[:MAX_PREFIX_LENGTH]:
+            node = node.get(char)
+            if node is None:
+                return []
+
+        products = node.get("", [])
+        if len(prefix) > MAX_PREFIX_LENGTH:
+            products = [product for product in products
+                        if any(word.startswith(prefix) for word in storage.word_starts(product[2]))]
+        return [{ "name": name, "num_voters": -num_voters }
+                for (num_voters, name, normalized_name) in products[:limit]]
+
+
+class Autocompleter:
+    """
+    Suggests product names for the networks of a storage backend.
+
+    Instances are safe to use from multiple threads.
+    """
+    def __init__(self, product_storage, max_products=MAX_PRODUCTS, max_age=MAX_AGE,
+                 warm_after=WARM_AFTER):
+        self.storage = product_storage
+        self.max_products = max_products
+        self.max_age = max_age
+        self.warm_after = warm_after
+
+        self._indexes = {} # network EID -> PrefixIndex
+        self._lookups = {} # network EID -> number of lookups while the index wasn't loaded
+        self._loading = set() # network EIDs of the indexes being loaded
+        self._can_find = True # whether the storage backend supports find_products()
+        self._lock = threading.Lock()
+
+    def suggest(self, network_eid, prefix, limit=SUGGESTIONS):
+        """
+        Returns the most popular products of a network with a word starting with the prefix.
+
+        @return List of dictionaries with name and num_voters properties, ordered by popularity.
+        """
+        index = self._indexes.get(network_eid)
+        if index is None or index.loaded_at < time.time() - self.max_age:
+            # only a single thread loads the index of a network, while the others keep using
+            # the expired index, or the storage backend if there is none yet
+            with self._lock:
+                lookups = self._lookups[network_eid] = self._lookups.get(network_eid, 0) + 1
+                warm = index is not None or lookups >= self.warm_after or not self._can_find
+                load = warm and network_eid not in self._loading
+                if load:
+                    self._loading.add(network_eid)
+            if load:
+                try:
+                    index = self._load(network_eid)
+                finally:
+                    with self._lock:
+                        self._loading.discard(network_eid)
+            elif index is None:
+                if not self._can_find:
+                    # the index is being loaded by another request
+                    return []
+                try:
+                    return self._find(network_eid, prefix, limit)
+                except NotImplementedError:
+                    # the index is loaded right away instead
+                    self._can_find = False
+                    return self.suggest(network_eid, prefix, limit)
+        return index.search(prefix, limit)
+
+    def add_vote(self, network_eid, name):
+        """
+        Adds a vote that was cast on a product to the index of its network, if loaded.
+
+        Only the name of the product is needed, so no storage calls are made. A product that
+        isn't indexed yet is added with a single voter, until the index is reloaded.
+        """
+        index = self._indexes.get(network_eid)
+        if index is not None:
+            index.add_vote(name)
+
+    def _find(self, network_eid, prefix, limit):
+        prefix = storage.normalize_name(prefix)
+        if not prefix:
+            return []
+        return [{ "name": entry["name"], "num_voters": entry["num_voters"] }
+                for entry in self.storage.find_products(network_eid, prefix, limit)]
+
+    def _load(self, network_eid):
+        index = PrefixIndex()
+        for entry in self.storage.iter_products(network_eid, self.max_products):
+            index.add(entry["name"], entry["num_voters"])
+        with self._lock:
+            self._indexes[network_eid] = index
+            self._lookups.pop(network_eid, None)
+        return index
@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the hot paths of the app.
+
+The datastore and memcache are replaced by the in-memory stubs of the App Engine SDK's testbed,
+so the benchmarks run locally without any external services. Run them with the Python 2.7
+interpreter the SDK runs on:
+
+  python benchmark.py --sdk /path/to/google_appengine --output results.json
+
+Every benchmark reports its throughput and latency percentiles. The results can be saved as JSON
+using --output, and compared against the results of an earlier run using --baseline, in which
+case every benchmark whose median latency grew by more than --tolerance is flagged as a
+regression and the exit status is 1.
+
+Absolute numbers depend on the machine and the stubs, so baselines should only be compared
+against runs on the same machine.
+"""
+
+import argparse
+import gc
+import imp
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from datetime import datetime
+from urllib import urlencode
+
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PERCENTILES = (50, 95, 99)
+
+DEFAULT_ITERATIONS = 200
+
+DEFAULT_TOLERANCE = 0.2
+
+# the network of all sessions and signed requests
+NETWORK_EID = "0a0000000000000a"
+
+# numbers of existing voters on the product that is voted on
+VOTER_COUNTS = (0, 100, 1000, 10000)
+
+# the number of voters of the most popular of the 20 products on the overview
+POPULARITIES = (20, 200, 2000)
+
+# the number of votes on every product when benchmarking the ranking of a storage backend
+STORAGE_VOTES = 100
+
+# the number of votes cast at once when benchmarking bulk voting
+BULK_VOTES = 500
+
+# the number of products to suggest from when benchmarking autocompletion
+AUTOCOMPLETE_PRODUCTS = 1000
+
+
+class Benchmark:
+    """
+    A single benchmark.
+
+    setup() is called once before the benchmark is run, and should return a function that runs
+    a single iteration. The function is passed the index of the iteration.
+    """
+    def __init__(self, name, setup):
+        self.name = name
+        self.setup = setup
+
+    def run(self, iterations, warmup):
+        function = self.setup(iterations + warmup)
+        for index in range(warmup):
+            function(index)
+
+        gc.collect()
+        gc.disable()
+        try:
+            timings = []
+            start = time.time()
+            for index in range(warmup, warmup + iterations):
+                iteration_start = time.time()
+                function(index)
+                timings.append(time.time() - iteration_start)
+            duration = time.time() - start
+        finally:
+            gc.enable()
+
+        return summarize(timings, duration)
+
+
+def summarize(timings, duration):
+    """
+    Summarizes the timings of the iterations of a benchmark.
+
+    @param timings List of the durations of the iterations in seconds.
+    @param duration Total duration of the benchmark in seconds.
+
+    @return Dictionary with the number of iterations, the throughput and the mean and percentile
+            latencies in milliseconds.
+    """
+    timings = sorted(timings)
+    result = {
+        "iterations": len(timings),
+        "ops_per_sec": round(len(timings) / duration, 1) if duration else 0,
+        "mean_ms": round(sum(timings) * 1000 / len(timings), 4)
+    }
+    for percentile in PERCENTILES:
+        index = min(len(timings) - 1, int(len(timings) * percentile / 100.0))
+        result["p%d_ms" % percentile] = round(timings[index] * 1000, 4)
+    return result
+
+def compare(results, baseline, tolerance):
+    """
+    Compares benchmark results against a baseline.
+
+    @param results Dictionary of benchmark results, keyed by benchmark name.
+    @param baseline Dictionary of baseline results, in the same format.
+    @param tolerance Fraction by which the median latency may grow before it's a regression.
+
+    @return List of (name, baseline p50, current p50) tuples of the regressed benchmarks.
+    """
+    regressions = []
+    for (name, result) in sorted(results.items()):
+        if name in baseline and \
+           result["p50_ms"] > baseline[name]["p50_ms"] * (1 + tolerance):
+            regressions.append((name, baseline[name]["p50_ms"], result["p50_ms"]))
+    return regressions
+
+
+class Environment:
+    """
+    The app running on top of the in-memory datastore and memcache stubs.
+    """
+    def __init__(self):
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # cross-group transactions require the high replication datastore
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=BENCHMARK_DIR)
+
+        self.app_module = imp.load_source("example_app",
+                                          os.path.join(BENCHMARK_DIR, "example-app.py"))
+
+        from webapp2_extras import securecookie
+        secret_key = self.app_module.config["webapp2_extras.sessions"]["secret_key"]
+        self.serializer = securecookie.SecureCookieSerializer(secret_key)
+
+        self.temp_dir = tempfile.mkdtemp()
+
+    def close(self):
+        self.testbed.deactivate()
+        shutil.rmtree(self.temp_dir)
+
+    def reset(self):
+        """Discards all entities and cached values."""
+        from google.appengine.api import memcache
+        from google.appengine.ext import testbed
+
+        self.testbed.get_stub(testbed.DATASTORE_SERVICE_NAME).Clear()
+        memcache.flush_all()
+
+    def session_token(self, user_eid):
+        """Returns the SESSION parameter of a session of the given user."""
+        return self.serializer.serialize("session", {
+            "userEID": user_eid,
+            "networkEID": NETWORK_EID
+        })
+
+    def request(self, method, session_token, params=None, headers=None):
+        """Performs a request to the overview page and returns the response."""
+        import webapp2
+
+        params = dict(params or {}, SESSION=session_token)
+        if method == "POST":
+            request = webapp2.Request.blank("/", POST=params, headers=headers)
+        else:
+            request = webapp2.Request.blank("/?" + urlencode(params), headers=headers)
+        response = request.get_response(self.app_module.app)
+        if response.status_int not in (200, 304):
+            raise Exception("Request failed with status %d" % response.status_int)
+        return response
+
+    def add_votes(self, product_name, num_voters, voter_prefix="voter"):
+        """Creates a product with the given number of votes, bypassing the vote path."""
+        from google.appengine.api import namespace_manager
+
+        # products are kept in the namespace of their network, see storage.py
+        namespace_manager.set_namespace(NETWORK_EID)
+        try:
+            return self._add_votes(product_name, num_voters, voter_prefix)
+        finally:
+            namespace_manager.set_namespace("")
+
+    def _add_votes(self, product_name, num_voters, voter_prefix):
+        import counters
+        import models
+
+        from google.appengine.ext import db
+
+        product = models.Product.get_or_insert_by_name(product_name)
+        keys = counters.shard_keys(product)
+        shards = [counters.VoteShard(key=key) for key in keys]
+        entities = []
+        for index in range(num_voters):
+            user_eid = "%s-%d" % (voter_prefix, index)
+            shard = shards[index % len(shards)]
+            shard.count += 1
+            if len(shard.voters) < counters.PREVIEW_SIZE:
+                shard.voters.append(user_eid)
+            entities.append(counters.Vote(key=counters.vote_key(product, user_eid)))
+            if len(entities) == 500:
+                db.put(entities)
+                entities = []
+        db.put(entities + shards)
+
+        product.num_voters = num_voters
+        product.put()
+        return product
+
+
+def signed_params(app_secret):
+    """Returns the parameters of a freshly signed request."""
+    import base64
+    import hashlib
+    import hmac
+    import speakap
+
+    params = {
+        "appData": "",
+        "issuedAt": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.000000+00:00"),
+        "locale": "en-US",
+        "networkEID": NETWORK_EID,
+        "userEID": "0b0000000000000b"
+    }
+    params["signature"] = base64.b64encode(
+        hmac.new(app_secret, speakap.signed_request(params), hashlib.sha256).digest())
+    return params
+
+def benchmarks(environment):
+    """Returns all benchmarks."""
+    import iso8601
+    import speakap
+    import storage
+
+    def validate_signature(iterations):
+        # a cache size of 0 evicts every signature right after validation, so every iteration
+        # computes the HMAC
+        api = speakap.API({ "scheme": "https", "hostname": "localhost",
+                            "app_id": "app", "app_secret": "secret" })
+        api.signature_validator = speakap.SignatureValidator("secret", cache_size=0)
+        params = signed_params("secret")
+        return lambda index: api.validate_signature(params)
+
+    def validate_signature_cached(iterations):
+        api = speakap.API({ "scheme": "https", "hostname": "localhost",
+                            "app_id": "app", "app_secret": "secret" })
+        params = signed_params("secret")
+        return lambda index: api.validate_signature(params)
+
+    def signed_request(iterations):
+        params = signed_params("secret")
+        return lambda index: speakap.signed_request(params)
+
+    def parse_date(datestring):
+        def setup(iterations):
+            iso8601.set_cache_size(0)
+            return lambda index: iso8601.parse_date(datestring)
+        return setup
+
+    def vote(num_voters):
+        def setup(iterations):
+            environment.reset()
+            environment.add_votes("Stapler", num_voters)
+            tokens = [environment.session_token("benchmark-%d" % index)
+                      for index in range(iterations)]
+            return lambda index: environment.request("POST", tokens[index],
+                                                     { "productName": "Stapler" })
+        return setup
+
+    def overview(popularity, mode):
+        # "conditional" revalidates the page, "cached" renders it using the cached product list,
+        # "rendered" renders the product list from the cached ranking and "cold" starts without
+        # anything in memcache
+        def setup(iterations):
+            import leaderboard
+
+            from google.appengine.api import memcache
+            from google.appengine.api import namespace_manager
+
+            environment.reset()
+            for index in range(20):
+                environment.add_votes("Product %d" % index, popularity * (index + 1) / 20)
+            token = environment.session_token("benchmark")
+            headers = { "If-None-Match": environment.request("GET", token).headers["ETag"] }
+
+            def run(index):
+                if mode == "conditional":
+                    environment.request("GET", token, headers=headers)
+                    return
+                elif mode == "rendered":
+                    namespace_manager.set_namespace(NETWORK_EID)
+                    leaderboard.bump_version()
+                    namespace_manager.set_namespace("")
+                elif mode == "cold":
+                    memcache.flush_all()
+                environment.request("GET", token)
+            return run
+        return setup
+
+    def storage_vote(create):
+        def setup(iterations):
+            backend = create()
+            return lambda index: backend.cast_vote(NETWORK_EID, "Product %d" % (index % 20),
+                                                   "voter-%d" % index)
+        return setup
+
+    def storage_bulk_vote(create):
+        def setup(iterations):
+            backend = create()
+            def run(index):
+                backend.cast_votes(NETWORK_EID, [
+                    ("Product %d" % (vote % 20), "voter-%d-%d" % (index, vote))
+                    for vote in range(BULK_VOTES)])
+            return run
+        return setup
+
+    def storage_top(create):
+        def setup(iterations):
+            backend = create()
+            for index in range(20 * STORAGE_VOTES):
+                backend.cast_vote(NETWORK_EID, "Product %d" % (index % 20), "voter-%d" % index)
+            return lambda index: backend.get_ranking(NETWORK_EID)
+        return setup
+
+    def autocomplete_suggest(create):
+        def setup(iterations):
+            import autocomplete
+            backend = create()
+            for index in range(AUTOCOMPLETE_PRODUCTS):
+                backend.cast_vote(NETWORK_EID, "Product %d" % index, "voter-%d" % index)
+            autocompleter = autocomplete.Autocompleter(backend, warm_after=0)
+            autocompleter.suggest(NETWORK_EID, "p")
+            return lambda index: autocompleter.suggest(NETWORK_EID, "product %d" % (index % 100))
+        return setup
+
+    def sqlite_storage():
+        return storage.SQLiteStorage(os.path.join(environment.temp_dir,
+                                                  "%f.sqlite" % time.time()))
+
+    result = [
+        Benchmark("speakap.validate_signature", validate_signature),
+        Benchmark("speakap.validate_signature (cached)", validate_signature_cached),
+        Benchmark("speakap.signed_request", signed_request),
+        Benchmark("iso8601.parse_date (canonical)", parse_date("2014-03-21T10:21:45.000000+00:00")),
+        Benchmark("iso8601.parse_date (offset)", parse_date("2014-03-21T10:21:45+01:00")),
+        Benchmark("iso8601.parse_date (basic format)", parse_date("20140321T102145Z")),
+    ]
+    for num_voters in VOTER_COUNTS:
+        result.append(Benchmark("MainPage.post (%d voters)" % num_voters, vote(num_voters)))
+    for popularity in POPULARITIES:
+        for mode in ("conditional", "cached", "rendered", "cold"):
+            result.append(Benchmark("MainPage.show_overview (20 products, up to %d voters, %s)" %
+                                    (popularity, mode), overview(popularity, mode)))
+    for (name, create) in (("memory", storage.MemoryStorage), ("sqlite", sqlite_storage)):
+        result.append(Benchmark("storage.cast_vote (%s)" % name, storage_vote(create)))
+        result.append(Benchmark("storage.cast_votes (%s, %d votes)" % (name, BULK_VOTES),
+                                storage_bulk_vote(create)))
+        result.append(Benchmark("storage.get_ranking (%s)" % name, storage_top(create)))
+        result.append(Benchmark("autocomplete.suggest (%d products, %s)" %
+                                (AUTOCOMPLETE_PRODUCTS, name), autocomplete_suggest(create)))
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the hot paths of the app.")
+    parser.add_argument("--sdk", help="path to the App Engine SDK, if it's not on the path")
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS,
+                        help="number of timed iterations per benchmark")
+    parser.add_argument("--warmup", type=int, default=10,
+                        help="number of untimed iterations per benchmark")
+    parser.add_argument("--filter", help="only run benchmarks containing this string")
+    parser.add_argument("--output", help="file to save the results to, as JSON")
+    parser.add_argument("--baseline", help="JSON file with results to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="fraction by which the median latency may grow (default 0.2)")
+    args = parser.parse_args()
+
+    if args.sdk:
+        sys.path.insert(0, args.sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    sys.path.insert(0, BENCHMARK_DIR)
+
+    environment = Environment()
+    results = {}
+    try:
+        for benchmark in benchmarks(environment):
+            if args.filter and args.filter not in benchmark.name:
+                continue
+            result = benchmark.run(args.iterations, args.warmup)
+            results[benchmark.name] = result
+            print "%-62s %10.1f ops/s  p50 %8.3fms  p95 %8.3fms  p99 %8.3fms" % (
+                benchmark.name, result["ops_per_sec"],
+                result["p50_ms"], result["p95_ms"], result["p99_ms"])
+    finally:
+        environment.close()
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({
+                "created_at": time.time(),
+                "python": platform.python_version(),
+                "machine": platform.node(),
+                "benchmarks": results
+            }, output, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline)["benchmarks"], args.tolerance)
+        for (name, baseline_ms, current_ms) in regressions:
+            print "REGRESSION %s: p50 %.3fms -> %.3fms (%+.0f%%)" % (
+                name, baseline_ms, current_ms, (current_ms / baseline_ms - 1) * 100)
+        if regressions:
+            sys.exit(1)
+        print "No regressions compared to %s" % args.baseline
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+
+"""
+Sharded vote counters for products.
+
+Writing every vote to the Product entity itself limits a single product to the write rate of one
+entity group. Instead, votes are counted on a number of VoteShard entities per product, picked at
+random for every vote. The number of shards is configured per product by Product.num_shards, so
+the write rate of a hot product can be raised by giving it more shards.
+
+Whether a user has voted on a product is recorded by a Vote entity keyed by the product and the
+user's EID, so checking for an existing vote is a single get by key, regardless of the number of
+voters. The Vote entity and the shard are written in a single cross-group transaction. Every
+shard keeps a preview of at most PREVIEW_SIZE voters for display purposes, so neither the shards
+nor the products grow with the number of voters.
+
+The num_voters property of the product is kept as a denormalized total so the overview can still
+be ranked by a datastore query. It is refreshed at most once every SYNC_INTERVAL seconds per
+product, while the exact count is obtained by summing the shards. Whenever the exact count is
+loaded for display and turns out to differ from the denormalized total, the total is refreshed as
+well. When a refresh is skipped because the product was synced less than SYNC_INTERVAL seconds
+ago, a task refreshing it SYNC_INTERVAL seconds later is queued instead, so the trailing votes of
+a burst always show up in the ranking, even for products that are never displayed. Every sync
+that changes a total bumps the version of the rankings (see leaderboard.get_version()), as the
+totals order the pages following the top-N.
+"""
+
+import hashlib
+import random
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+
+DEFAULT_NUM_SHARDS = 10
+
+PREVIEW_SIZE = 10
+
+SYNC_INTERVAL = 10 # seconds
+
+SYNC_URL = "/tasks/sync-num-voters"
+
+XG_OPTIONS = db.create_transaction_options(xg=True)
+
+# a cross-group transaction spans at most 25 entity groups. every vote, shard and product is an
+# entity group of its own
+MAX_GROUPS_PER_TRANSACTION = 25
+
+MAX_TASKS_PER_ADD = 100 # the maximum number of tasks that can be added at once
+
+
+class Vote(db.Model):
+    created = db.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+class VoteShard(db.Model):
+    count = db.IntegerProperty(default=0, indexed=False)
+    voters = db.StringListProperty(indexed=False)
+
+
+def shard_keys(product):
+    """Returns the keys of all shards belonging to a product."""
+    return _shard_keys(product.key(), product.num_shards)
+
+def vote_key(product, user_eid):
+    """Returns the key of the Vote entity recording the vote of a user on a product."""
+    product_key = product.key()
+    return db.Key.from_path("Vote", "%s|%s" % (product_key.name(), user_eid),
+                            namespace=product_key.namespace())
+
+def has_voted(product, user_eid):
+    """Returns whether the given user has voted on the product."""
+    return db.get(vote_key(product, user_eid)) is not None
+
+def cast_vote(product, user_eid):
+    """
+    Registers a vote of a user on a product.
+
+    @param product The (saved) Product entity to vote on.
+    @param user_eid EID of the user casting the vote.
+
+    @return True if the vote was counted, False if the user had already voted on the product.
+    """
+    key = random.choice(shard_keys(product))
+    if not db.run_in_transaction_options(XG_OPTIONS, _add_votes,
+                                         [(key, [vote_key(product, user_eid)], [user_eid])])[0]:
+        return False
+
+    sync_num_voters(product)
+    return True
+
+def cast_votes(product, user_eids):
+    """
+    Registers the votes of multiple users on a product.
+
+    @param product The (saved) Product entity to vote on.
+    @param user_eids List of EIDs of the users casting a vote. Duplicates are ignored.
+
+    @return List of the EIDs whose votes were counted.
+
+    Existing votes are filtered out using a single batch get, after which the remaining votes are
+    written in cross-group transactions of up to MAX_GROUPS_PER_TRANSACTION - 1 votes each.
+    """
+    return cast_batch([(product, user_eids)])[0]
+
+def cast_batch(votes):
+    """
+    Registers the votes of multiple users on multiple products.
+
+    @param votes List of (product, user EIDs) tuples, where product is a (saved) Product entity
+                 and user EIDs is a list of EIDs of the users casting a vote on it. Duplicates are
+                 ignored.
+
+    @return List containing the list of the EIDs whose votes were counted for every product.
+
+    Like cast_votes(), but existing votes on all products are filtered out using a single batch
+    get, and the votes on different products share transactions, so the number of transactions
+    depends on the number of votes rather than the number of products. The products are synced
+    using sync_batch().
+    """
+    unique_votes = []
+    for (product, user_eids) in votes:
+        seen = set()
+        for user_eid in user_eids:
+            if user_eid not in seen:
+                seen.add(user_eid)
+                unique_votes.append((product, user_eid))
+
+    keys = [vote_key(product, user_eid) for (product, user_eid) in unique_votes]
+    new_votes = {} # product key -> list of (vote key, user EID)
+    for (key, (product, user_eid), vote) in zip(keys, unique_votes, db.get(keys)):
+        if vote is None:
+            new_votes.setdefault(product.key(), []).append((key, user_eid))
+
+    # every vote takes an entity group of its own, and so does the shard of every product the
+    # votes of a transaction are counted on
+    transactions = [] # list of lists of (product index, shard key, vote keys, user EIDs)
+    num_groups = MAX_GROUPS_PER_TRANSACTION
+    for (index, (product, user_eids)) in enumerate(votes):
+        product_votes = new_votes.pop(product.key(), [])
+        while product_votes:
+            if num_groups > MAX_GROUPS_PER_TRANSACTION - 2:
+                transactions.append([])
+                num_groups = 0
+            chunk = product_votes[:MAX_GROUPS_PER_TRANSACTION - num_groups - 1]
+            product_votes = product_votes[len(chunk):]
+            transactions[-1].append((index, random.choice(shard_keys(product)),
+                                     [key for (key, user_eid) in chunk],
+                                     [user_eid for (key, user_eid) in chunk]))
+            num_groups += len(chunk) + 1
+
+    result = [[] for vote in votes]
+    for transaction in transactions:
+        counted = db.run_in_transaction_options(XG_OPTIONS, _add_votes,
+                                                [(shard_key, vote_keys, user_eids)
+                                                 for (index, shard_key, vote_keys, user_eids)
+                                                 in transaction])
+        for ((index, shard_key, vote_keys, user_eids), eids) in zip(transaction, counted):
+            result[index].extend(eids)
+
+    sync_batch([product for ((product, user_eids), counted) in zip(votes, result) if counted])
+    return result
+
+def load_counts(products):
+    """
+    Loads the exact vote counts and a preview of the voters of the given products.
+
+    @param products List of Product entities.
+
+    The num_voters property of the products is overwritten with the sum of all shards, and the
+    voters property with at most PREVIEW_SIZE voters. The products are not saved. Only a single
+    batch get is performed, regardless of the number of products.
+    """
+    keys = []
+    for product in products:
+        keys.extend(shard_keys(product))
+    shards = db.get(keys)
+
+    offset = 0
+    changed = {} # product key -> count
+    for product in products:
+        voters = []
+        count = 0
+        for shard in shards[offset:offset + product.num_shards]:
+            if shard:
+                voters.extend(shard.voters[:PREVIEW_SIZE - len(voters)])
+                count += shard.count
+        offset += product.num_shards
+
+        if count != product.num_voters:
+            changed[product.key()] = count
+
+        product.voters = voters
+        product.num_voters = count
+
+    if changed:
+        _save_counts([(product_key, changed[product_key])
+                      for product_key in _may_sync(changed.keys())])
+
+def load_previews(product_keys):
+    """
+    Loads a preview of the voters of the given products.
+
+    @param product_keys List of the keys of Product entities.
+
+    @return List containing a list of at most PREVIEW_SIZE voter EIDs for every product.
+
+    Unlike load_counts(), only the keys of the products are needed, so the products can be
+    loaded using a projection query. As their number of shards isn't known, only the first
+    DEFAULT_NUM_SHARDS shards of every product are read, which hold a random sample of the voters
+    of products with more shards. Only a single batch get is performed, regardless of the number
+    of products.
+    """
+    keys = []
+    for product_key in product_keys:
+        keys.extend(_shard_keys(product_key, DEFAULT_NUM_SHARDS))
+    shards = db.get(keys)
+
+    previews = []
+    for offset in range(0, len(shards), DEFAULT_NUM_SHARDS):
+        voters = []
+        for shard in shards[offset:offset + DEFAULT_NUM_SHARDS]:
+            if shard:
+                voters.extend(shard.voters[:PREVIEW_SIZE - len(voters)])
+        previews.append(voters)
+    return previews
+
+def sync_num_voters(product):
+    """
+    Updates the denormalized num_voters property of a product with the sum of its shards.
+
+    The update is skipped if the product has been synced less than SYNC_INTERVAL seconds ago,
+    which limits the number of writes to the product entity regardless of the vote rate. In that
+    case the update is deferred to a task, see sync_product().
+    """
+    sync_batch([product])
+
+def sync_batch(products):
+    """
+    Updates the denormalized num_voters property of multiple products, see sync_num_voters().
+
+    The shards of all products are loaded using a single batch get, and the products are updated
+    in cross-group transactions of up to MAX_GROUPS_PER_TRANSACTION products each. The
+    num_voters property of the given entities is updated as well.
+    """
+    syncable = set(_may_sync([product.key() for product in products]))
+    products = [product for product in products if product.key() in syncable]
+    if not products:
+        return
+
+    keys = []
+    for product in products:
+        keys.extend(shard_keys(product))
+    shards = db.get(keys)
+
+    offset = 0
+    for product in products:
+        product.num_voters = sum(shard.count
+                                 for shard in shards[offset:offset + product.num_shards] if shard)
+        offset += product.num_shards
+    _save_counts([(product.key(), product.num_voters) for product in products])
+
+def sync_product(product_key):
+    """
+    Updates the denormalized num_voters property of a product, regardless of when it was last
+    synced. Invoked by the task queued when a sync is skipped, see SYNC_URL.
+
+    @param product_key Key of the Product entity, or its string representation.
+    """
+    product = db.get(product_key)
+    if product is None:
+        return
+
+    count = 0
+    for shard in db.get(shard_keys(product)):
+        if shard:
+            count += shard.count
+    _save_counts([(product.key(), count)])
+
+def _may_sync(product_keys):
+    # returns the keys of the products that may be synced now, using a single memcache call
+    if not product_keys:
+        return []
+    blocked = set(memcache.add_multi(dict((str(product_key), 1) for product_key in product_keys),
+                                     time=SYNC_INTERVAL, key_prefix="vote-sync:"))
+    if blocked:
+        _queue_syncs([product_key for product_key in product_keys
+                      if str(product_key) in blocked])
+    return [product_key for product_key in product_keys if str(product_key) not in blocked]
+
+def _queue_syncs(product_keys):
+    # a single task per product and interval, which runs once the interval has passed. the
+    # memcache keys only save trying to add the same tasks for every vote
+    interval = int(time.time() / SYNC_INTERVAL) + 1
+    queued = set(memcache.add_multi(dict((str(product_key), 1) for product_key in product_keys),
+                                    time=2 * SYNC_INTERVAL,
+                                    key_prefix="vote-sync-task:%d:" % interval))
+    tasks = [taskqueue.Task(url=SYNC_URL, params={ "key": str(product_key) },
+                            name="sync-%s-%d" % (hashlib.sha1(str(product_key)).hexdigest(),
+                                                 interval),
+                            countdown=SYNC_INTERVAL)
+             for product_key in product_keys if str(product_key) not in queued]
+
+    queue = taskqueue.Queue()
+    for offset in range(0, len(tasks), MAX_TASKS_PER_ADD):
+        try:
+            queue.add(tasks[offset:offset + MAX_TASKS_PER_ADD])
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            # the other tasks of the batch are still added
+            pass
+
+def _save_counts(counts):
+    # counts is a list of (product key, count) tuples
+    changed = []
+    for offset in range(0, len(counts), MAX_GROUPS_PER_TRANSACTION):
+        changed.extend(db.run_in_transaction_options(
+            XG_OPTIONS, _set_num_voters, counts[offset:offset + MAX_GROUPS_PER_TRANSACTION]))
+
+    # the denormalized totals order the pages following the top-N, so pages rendered from the
+    # ranking are outdated. imported here, as the leaderboard imports this module
+    import leaderboard
+    for namespace in set(product_key.namespace() for product_key in changed):
+        leaderboard.bump_version(namespace)
+
+def _shard_keys(product_key, num_shards):
+    # keyed by the key name of the product rather than its complete key, which is a lot longer.
+    # the namespace is taken from the product, as tasks syncing products run in the default
+    # namespace
+    return [db.Key.from_path("VoteShard", "%s:%d" % (product_key.name(), index),
+                             namespace=product_key.namespace())
+            for index in range(num_shards)]
+
+def _add_votes(votes):
+    # votes is a list of (shard key, vote keys, user EIDs) tuples. returns the list of the EIDs
+    # whose votes were counted for every tuple
+    keys = [shard_key for (shard_key, vote_keys, user_eids) in votes]
+    for (shard_key, vote_keys, user_eids) in votes:
+        keys.extend(vote_keys)
+    entities = db.get(keys)
+
+    shards = {} # shard key -> shard
+    for (shard_key, shard) in zip(keys, entities[:len(votes)]):
+        shards.setdefault(shard_key, shard or VoteShard(key=shard_key))
+    existing = entities[len(votes):]
+
+    new_votes = []
+    changed = {} # shard key -> shard
+    result = []
+    offset = 0
+    for (shard_key, vote_keys, user_eids) in votes:
+        counted = []
+        for (key, user_eid, vote) in zip(vote_keys, user_eids,
+                                         existing[offset:offset + len(vote_keys)]):
+            if vote is None:
+                new_votes.append(Vote(key=key))
+                counted.append(user_eid)
+        offset += len(vote_keys)
+        result.append(counted)
+        if not counted:
+            continue
+
+        shard = changed[shard_key] = shards[shard_key]
+        shard.count += len(counted)
+        shard.voters.extend(counted[:max(0, PREVIEW_SIZE - len(shard.voters))])
+
+    if new_votes:
+        db.put(new_votes + changed.values())
+    return result
+
+def _set_num_voters(counts):
+    # counts is a list of (product key, count) tuples. returns the keys of the changed products
+    products = db.get([product_key for (product_key, count) in counts])
+    changed = []
+    for (product, (product_key, count)) in zip(products, counts):
+        if product and product.num_voters != count:
+            product.num_voters = count
+            changed.append(product)
+    db.put(changed)
+    return [product.key() for product in changed]
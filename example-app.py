@@ -1,38 +1,142 @@
-import jinja2
+import startup
+
+import base64
+import hashlib
+import json
 import logging
 import os
-import speakap
-import webapp2
 
-from google.appengine.ext import db
+from urllib import quote
+
+with startup.timed("import webapp2"):
+    import stats
+    import webapp2
 
-from speakap_api import speakap_api
-from speakap_api import SPEAKAP_APP_ID
+    from webapp2_extras import sessions
+
+with startup.timed("import storage"):
+    import autocomplete
+    import storage
+
+try:
+    from google.appengine.api import memcache
+    from google.appengine.api import users
+except ImportError:
+    # not running on Google App Engine
+    memcache = None
+    users = None
+
+# modules that aren't needed by every request are imported on first use
+counters = startup.lazy_import("counters")
+jinja2 = startup.lazy_import("jinja2")
+migration = startup.lazy_import("migration")
+speakap = startup.lazy_import("speakap")
+speakap_api = startup.lazy_import("speakap_api")
+trending = startup.lazy_import("trending")
+votebuffer = startup.lazy_import("votebuffer")
 
-from urllib import quote
 
-from webapp2_extras import sessions
+# with the "securecookie" backend, the SESSION parameter is a signed token containing the session
+# data itself, so sessions don't require any storage round trips and can't be evicted. with the
+# "memcache" backend, the SESSION parameter only contains the ID of a session stored in memcache
+SESSION_BACKEND = "securecookie"
 
+# the number of seconds after which a session expires
+SESSION_MAX_AGE = 24 * 60 * 60
 
 config = {}
 config["webapp2_extras.sessions"] = {
     "secret_key": "fi3vjhugu3uk,hlncwicew8023p;23dgvxgthg",
+    "session_max_age": SESSION_MAX_AGE,
 }
 
-JINJA_ENVIRONMENT = jinja2.Environment(
-    loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
-    extensions=["jinja2.ext.autoescape"])
+# where products and votes are stored: "datastore" on App Engine, "sqlite" or "memory" to run the
+# app under other WSGI servers, see storage.py
+STORAGE_BACKEND = "datastore"
+
+# the database file of the "sqlite" backend
+SQLITE_DATABASE = os.path.join(os.path.dirname(__file__), "votes.sqlite")
+
+# when enabled, votes are acknowledged immediately and written to the datastore in batches by the
+# /tasks/flush-votes cron job, see votebuffer.py. only supported by the "datastore" backend
+WRITE_BEHIND_VOTES = False
+
+# when enabled, the "datastore" backend stores the prefixes of the words of product names, so
+# autocompletion can query them before the index of a network has been loaded (see
+# autocomplete.py). this requires the name_prefixes index in index.yaml, and makes creating
+# products more expensive, as every prefix is an index row
+AUTOCOMPLETE_DATASTORE_INDEX = False
+
+# when enabled, the overview is sent while it's being rendered, so the browser can start loading
+# the stylesheets and scripts in the head before the ranking has been loaded. note App Engine
+# itself buffers responses, so this only lowers the time to first byte on other WSGI servers
+STREAM_TEMPLATES = False
+
+# the number of seconds the rendered product list of a version of the ranking is cached in
+# memcache, or 0 to disable the cache
+FRAGMENT_CACHE_TIME = 60
+
+# changes with every deployment, so pages rendered by previous versions are never reused
+APP_VERSION = os.environ.get("CURRENT_VERSION_ID", "")
+
+_jinja_environment = None
 
+def jinja_environment():
+    """Returns the Jinja environment, which is created on first use."""
+    global _jinja_environment
+    if _jinja_environment is None:
+        with startup.timed("create Jinja environment"):
+            # the compiled templates are cached in memcache, so new instances don't need to
+            # compile them. the templates don't change while an instance is running, so there's
+            # no need to check for updates
+            _jinja_environment = jinja2.Environment(
+                loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
+                extensions=["jinja2.ext.autoescape"],
+                auto_reload=False,
+                bytecode_cache=jinja2.MemcachedBytecodeCache(memcache) if memcache else None)
+    return _jinja_environment
 
-class Product(db.Model):
-    name = db.StringProperty(required=True)
-    voters = db.StringListProperty(indexed=False)
-    num_voters = db.IntegerProperty(default=0)
+def create_storage():
+    """Returns the storage backend configured by STORAGE_BACKEND."""
+    if STORAGE_BACKEND == "sqlite":
+        return storage.SQLiteStorage(SQLITE_DATABASE)
+    elif STORAGE_BACKEND == "memory":
+        return storage.MemoryStorage()
+    else:
+        return storage.DatastoreStorage(write_behind=WRITE_BEHIND_VOTES,
+                                        index_prefixes=AUTOCOMPLETE_DATASTORE_INDEX)
 
+product_storage = create_storage()
 
-class MainPage(webapp2.RequestHandler):
+# suggests the names of existing products while users type, see autocomplete.py
+autocompleter = autocomplete.Autocompleter(product_storage)
+
+
+# the maximum number of voters of which the profiles can be requested at once
+MAX_VOTER_PROFILES = 200
+
+# the maximum number of votes that can be cast by a single request to /api/votes
+MAX_BULK_VOTES = 1000
+
+
+def is_admin(request):
+    """
+    Returns whether a request was made by an administrator of the app.
+
+    On App Engine, this is a signed in administrator. Under other WSGI servers, where the
+    restrictions in app.yaml don't apply, only requests from the host itself are trusted.
+    """
+    if users:
+        return users.is_current_user_admin()
+    return request.remote_addr in ("127.0.0.1", "::1")
+
+
+class SessionHandler(webapp2.RequestHandler):
+    """Base class for handlers of requests within a user session."""
 
     def dispatch(self):
+        startup.request_started()
+
         # by default, the session ID is set in the Cookie header, but we can't rely on
         # cookies because of 3rd party cookie restrictions. so we pass the session ID through GET
         # parameters and unset the cookie before the response is sent
@@ -40,7 +144,8 @@ class MainPage(webapp2.RequestHandler):
         if self.session_id:
             self.request.cookies["session"] = self.session_id
             self.session_store = sessions.get_store(request=self.request)
-            self.session # touch the object to guarantee its instantiation
+            with stats.timed("session"):
+                self.session # touch the object to guarantee its instantiation
         else:
             self.session_store = sessions.get_store(request=self.request)
 
@@ -48,16 +153,23 @@ class MainPage(webapp2.RequestHandler):
                 # there was no session yet, so we assume a valid signed request from Speakap
                 # if the signed request is not valid, an exception is raised
                 signed_params = dict(self.request.params)
-                speakap_api.validate_signature(signed_params)
+                with stats.timed("signature"):
+                    speakap_api.speakap_api.validate_signature(signed_params)
 
                 # we copy all parameters from the signed request to a new user session (the session
                 # is created implicitly), so the params are available on follow-up requests
                 for key in signed_params:
                     self.session[key] = signed_params[key]
 
-                self.session_store.save_sessions(self.response)
-                # ugly method to get the session ID from the Set-Cookie header
-                self.session_id = self.response.headers["Set-Cookie"].split(";")[0].split("=", 2)[1]
+                with stats.timed("session"):
+                    if SESSION_BACKEND == "securecookie":
+                        self.session_id = self.session_store.serializer.serialize(
+                            "session", dict(self.session))
+                    else:
+                        self.session_store.save_sessions(self.response)
+                        # ugly method to get the session ID from the Set-Cookie header
+                        self.session_id = \
+                            self.response.headers["Set-Cookie"].split(";")[0].split("=", 2)[1]
             except speakap.SignatureValidationError, exception:
                 print exception
                 self.show_auth_error()
@@ -66,17 +178,57 @@ class MainPage(webapp2.RequestHandler):
         try:
             webapp2.RequestHandler.dispatch(self)
         finally:
-            self.session_store.save_sessions(self.response)
-            try:
-                self.response.unset_cookie("session")
-            except:
-                pass
+            # the token is passed through the SESSION parameter, not through the cookie, so a
+            # secure cookie session cannot be modified after it has been created
+            if SESSION_BACKEND != "securecookie":
+                with stats.timed("session"):
+                    self.session_store.save_sessions(self.response)
+                try:
+                    self.response.unset_cookie("session")
+                except:
+                    pass
+
+    @webapp2.cached_property
+    def session(self):
+        return self.session_store.get_session(backend=SESSION_BACKEND)
+
+    def show_auth_error(self):
+        """Displays an error message."""
+        self.response.set_status(403)
+        self.response.write("Forbidden - This App can only be accessed through Speakap")
+
+    def verify_session(self):
+        if not self.session_id:
+            raise Exception("No session ID available")
+
+        if SESSION_BACKEND != "securecookie":
+            self.request.headers["Cookie"] = "session=" + quote(self.session_id)
+        if not self.session.get("userEID"):
+            raise Exception("No valid session")
+
+
+class MainPage(SessionHandler):
 
     def get(self):
         try:
             self.verify_session()
 
-            self.show_overview()
+            cursor = self.request.get("cursor")
+            show_trending = self.request.get("ranking") == "trending"
+
+            # the version is obtained before the ranking is loaded, so if the ranking changes in
+            # between, the page is tagged with the older version and rendered again next time
+            with stats.timed("version"):
+                version = product_storage.get_version(self.session.get("networkEID"))
+            etag = self.overview_etag(version, cursor, show_trending)
+            # a 304 response repeats the validators of the page it stands for
+            self.response.headers["ETag"] = '"%s"' % etag
+            self.response.headers["Cache-Control"] = "private, no-cache"
+            if etag in self.request.if_none_match:
+                self.response.set_status(304)
+                return
+
+            self.show_overview(cursor=cursor, show_trending=show_trending, version=version)
         except Exception, exception:
             self.show_auth_error()
 
@@ -86,70 +238,329 @@ class MainPage(webapp2.RequestHandler):
 
             # add our vote for a product, if requested
             product_name = self.request.get("productName")
-            if product_name:
-                q = Product.gql("WHERE name = :1", product_name)
-                product = q.get()
-                if not product:
-                    product = Product(name=product_name, num_voters=0)
-                user_eid = self.session.get("userEID")
-                if user_eid not in product.voters:
-                    product.voters.append(user_eid)
-                    product.num_voters += 1
-                product.put()
-
-            self.show_overview()
+            user_eid = self.session.get("userEID")
+            with stats.timed("vote"):
+                voted = product_storage.cast_vote(self.session.get("networkEID"),
+                                                  product_name, user_eid)
+            if voted:
+                autocompleter.add_vote(self.session.get("networkEID"), product_name)
+
+            self.show_overview(pending_vote=(product_name, user_eid) if voted else None)
         except Exception, exception:
             print exception
             self.show_auth_error()
 
-    @webapp2.cached_property
-    def session(self):
-        return self.session_store.get_session(backend="memcache")
-
-    def show_auth_error(self):
-        """Displays an error message."""
-        self.response.set_status(403)
-        self.response.write("Forbidden - This App can only be accessed through Speakap")
-
-    def show_overview(self):
-        """Display the default overview."""
-        q = Product.gql("ORDER BY num_voters DESC")
-        products = q.fetch(limit=20)
-
-        # because the App Engine DB uses eventual consistency, we may have to fake the result
-        # if we just voted on something by manually adding our own vote if it doesn't exist yet
-        product_name = self.request.get("productName")
+    def overview_etag(self, version, cursor, show_trending):
+        """
+        Returns the ETag of the overview of the given version of the ranking, for this user.
+
+        Besides the ranking, the overview contains the session of the user, so the ETag is
+        different for every user.
+        """
+        return hashlib.sha1("|".join([
+            APP_VERSION, str(version), cursor or "", "trending" if show_trending else "",
+            self.session.get("userEID") or "", self.session_id
+        ]).encode("utf-8")).hexdigest()
+
+    def show_overview(self, cursor=None, pending_vote=None, show_trending=False, version=None):
+        """
+        Display the default overview.
+
+        cursor is the cursor of the page of the ranking to display, or None for the first page.
+        pending_vote is the (product name, user EID) tuple of the vote the user just cast, which
+        may not be counted yet, see Storage.get_ranking(). If show_trending is True, the trending
+        products are displayed instead of the ranking.
+
+        If the version of the ranking is given, the rendered product list is cached for
+        FRAGMENT_CACHE_TIME seconds, as it's the same for all users of the network.
+        """
         user_eid = self.session.get("userEID")
-        if product_name:
-            found = False
-            for product in products:
-                if product.name == product_name:
-                    if user_eid not in product.voters:
-                        product.voters.append(user_eid)
-                    found = True
-            if not found and len(products) < 20:
-                product = Product(name=product_name, num_voters=1)
-                product.voters.append(user_eid)
-                products.append(product)
+        network_eid = self.session.get("networkEID")
+        products = RankingPage(network_eid, cursor, pending_vote, show_trending)
+
+        cache_key = None
+        if version is not None and not pending_vote and memcache and FRAGMENT_CACHE_TIME:
+            cache_key = "products:" + hashlib.sha1("|".join([
+                APP_VERSION, network_eid or "", str(version), cursor or "",
+                "trending" if show_trending else ""
+            ]).encode("utf-8")).hexdigest()
+
+        def product_list():
+            # rendered while the page is rendered, so a streamed page can be sent before the
+            # ranking is loaded
+            html = memcache.get(cache_key) if cache_key else None
+            if html is None:
+                html = jinja_environment().get_template("products.html").render(products=products)
+                if cache_key:
+                    memcache.set(cache_key, html, time=FRAGMENT_CACHE_TIME)
+            return jinja2.Markup(html)
 
         template_values = {
-            "app_id": SPEAKAP_APP_ID,
-            "products": products,
+            "app_id": speakap_api.SPEAKAP_APP_ID,
+            "product_list": product_list,
             "session_id": self.session_id,
             "signed_request": speakap.signed_request(self.session),
+            "trending": show_trending,
             "user_eid": user_eid
         }
 
-        template = JINJA_ENVIRONMENT.get_template("index.html")
-        self.response.write(template.render(template_values))
+        template = jinja_environment().get_template("index.html")
+        if STREAM_TEMPLATES:
+            self.response.app_iter = (chunk.encode("utf-8")
+                                      for chunk in template.generate(template_values))
+        else:
+            with stats.timed("render"):
+                self.response.write(template.render(template_values))
+
+
+class RankingPage(object):
+    """
+    Page of the ranked products of a network, which is only loaded once it's first used.
+
+    Iterating over the page yields its products. If the cursor is invalid, the first page is
+    loaded instead. The trending products are a single page.
+    """
+
+    def __init__(self, network_eid, cursor=None, pending_vote=None, show_trending=False):
+        self.network_eid = network_eid
+        self.cursor = cursor
+        self.pending_vote = pending_vote
+        self.show_trending = show_trending
+        self._products = None
+        self._next_cursor = None
+
+    def load(self):
+        if self._products is None:
+            with stats.timed("ranking"):
+                if self.show_trending:
+                    self._products = product_storage.get_trending(self.network_eid)
+                else:
+                    try:
+                        (self._products, self._next_cursor) = product_storage.get_ranking(
+                            self.network_eid, self.cursor, self.pending_vote)
+                    except storage.InvalidCursorError, exception:
+                        logging.warning(exception)
+                        (self._products, self._next_cursor) = product_storage.get_ranking(
+                            self.network_eid, None, self.pending_vote)
+        return self._products
+
+    @property
+    def next_cursor(self):
+        self.load()
+        return self._next_cursor
+
+    def __iter__(self):
+        return iter(self.load())
+
+
+class VoterProfiles(SessionHandler):
 
-    def verify_session(self):
-        if not self.session_id:
-            raise Exception("No session ID available")
+    def get(self):
+        """
+        Returns the avatars and names of the voters given by the eid parameters, as a JSON object
+        mapping every EID to an object with avatarThumbnailUrl and fullName properties.
 
-        self.request.headers["Cookie"] = "session=" + quote(self.session_id)
-        if not self.session.get("userEID"):
-            raise Exception("No valid session")
+        The profiles are fetched from the Speakap API concurrently, and are cached by the
+        response cache of the API wrapper.
+        """
+        try:
+            self.verify_session()
+        except Exception, exception:
+            self.show_auth_error()
+            return
+
+        network_eid = self.session.get("networkEID")
+        voter_eids = []
+        for voter_eid in self.request.get_all("eid"):
+            if voter_eid and voter_eid not in voter_eids:
+                voter_eids.append(voter_eid)
+        voter_eids = voter_eids[:MAX_VOTER_PROFILES]
+
+        results = speakap_api.speakap_api.gather([
+            ("GET", "/networks/%s/user/%s/" % (quote(network_eid, ""), quote(voter_eid, "")))
+            for voter_eid in voter_eids
+        ])
+
+        profiles = {}
+        for (voter_eid, (json_result, error)) in zip(voter_eids, results):
+            if error:
+                logging.warning("Could not fetch profile of %s: %s", voter_eid, error["message"])
+            else:
+                profiles[voter_eid] = {
+                    "avatarThumbnailUrl": json_result.get("avatarThumbnailUrl"),
+                    "fullName": json_result.get("fullName")
+                }
+
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.write(json.dumps(profiles))
+
+
+class Autocomplete(SessionHandler):
+
+    def get(self):
+        """
+        Returns the most popular products of the network with a word starting with the q
+        parameter, as a JSON array of objects with name and numVoters properties.
+
+        Suggestions are looked up in the prefix index of the instance, see autocomplete.py.
+        """
+        try:
+            self.verify_session()
+        except Exception, exception:
+            self.show_auth_error()
+            return
+
+        with stats.timed("autocomplete"):
+            products = autocompleter.suggest(self.session.get("networkEID"),
+                                             self.request.get("q"))
+
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.headers["Cache-Control"] = "private, max-age=60"
+        self.response.write(json.dumps([{ "name": product["name"],
+                                          "numVoters": product["num_voters"] }
+                                        for product in products]))
+
+
+class BulkVotes(webapp2.RequestHandler):
+
+    def post(self):
+        """
+        Casts multiple votes at once, for example when importing votes, see import_votes.py.
+
+        The body is a JSON object with a votes property, containing an array of at most
+        MAX_BULK_VOTES objects with productName and userEID properties, where userEID is a valid
+        EID (see speakap.EID_PATTERN), as it's rendered as is. The query string is a
+        signed request with a networkEID parameter and a bodyDigest parameter containing the
+        base64 encoded SHA-256 digest of the body, so the votes are covered by the signature.
+
+        Returns a JSON object with the numbers of votes and counted votes, and a counted array
+        telling whether every vote was counted.
+        """
+        params = dict(self.request.GET)
+        try:
+            with stats.timed("signature"):
+                speakap_api.speakap_api.validate_signature(params)
+        except speakap.SignatureValidationError, exception:
+            logging.warning(exception)
+            self.response.set_status(403)
+            self.response.write("Forbidden - Invalid signature")
+            return
+
+        digest = base64.b64encode(hashlib.sha256(self.request.body).digest())
+        if params.get("bodyDigest") != digest:
+            self.response.set_status(403)
+            self.response.write("Forbidden - Body does not match its digest")
+            return
+
+        # the network EID names the namespace the votes are stored in
+        network_eid = params.get("networkEID")
+        if not network_eid or not speakap.EID_PATTERN.match(network_eid):
+            self.response.set_status(400)
+            self.response.write("Bad Request - Missing or invalid networkEID parameter")
+            return
+
+        try:
+            votes = [(vote["productName"], vote["userEID"])
+                     for vote in json.loads(self.request.body)["votes"]]
+            if not all(isinstance(product_name, basestring) and isinstance(user_eid, basestring)
+                       and speakap.EID_PATTERN.match(user_eid)
+                       for (product_name, user_eid) in votes):
+                raise ValueError("Invalid vote")
+        except (KeyError, TypeError, ValueError), exception:
+            self.response.set_status(400)
+            self.response.write("Bad Request - %s" % exception)
+            return
+
+        if len(votes) > MAX_BULK_VOTES:
+            self.response.set_status(413)
+            self.response.write("Request Entity Too Large - At most %d votes" % MAX_BULK_VOTES)
+            return
+
+        with stats.timed("bulk votes"):
+            counted = product_storage.cast_votes(network_eid, votes)
+
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.write(json.dumps({
+            "numVotes": len(votes),
+            "numCounted": counted.count(True),
+            "counted": counted
+        }))
+
+
+class FlushVotes(webapp2.RequestHandler):
+
+    def get(self):
+        """Writes buffered votes to the datastore. Invoked by cron, see cron.yaml."""
+        flush_stats = votebuffer.flush(AUTOCOMPLETE_DATASTORE_INDEX)
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.write(json.dumps(flush_stats))
+
+
+class SyncNumVoters(webapp2.RequestHandler):
+
+    def post(self):
+        """Updates the total number of voters of a product. Queued by counters.sync_num_voters()."""
+        counters.sync_product(self.request.get("key"))
+
+
+class AggregateTrending(webapp2.RequestHandler):
+
+    def get(self):
+        """Aggregates new votes into the trending ranking. Invoked by cron, see cron.yaml."""
+        num_aggregated = trending.aggregate()
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.write(json.dumps({ "num_aggregated": num_aggregated }))
+
+
+class MigrateProducts(webapp2.RequestHandler):
+
+    def get(self):
+        """
+        Migrates the products from before products were keyed by name to the network given by
+        the network parameter, see migration.py. Run until the result says it's done.
+        """
+        network_eid = self.request.get("network")
+        if not network_eid:
+            self.response.set_status(400)
+            self.response.write("Bad Request - Missing network parameter")
+            return
+
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.write(json.dumps(migration.migrate_products(network_eid,
+                                                                  AUTOCOMPLETE_DATASTORE_INDEX)))
+
+
+class Warmup(webapp2.RequestHandler):
+
+    def get(self):
+        """Initializes the instance before it receives its first request."""
+        startup.load_all()
+        with startup.timed("load templates"):
+            jinja_environment().get_template("index.html")
+        startup.request_started()
+
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.write(json.dumps(startup.report()))
+
+
+class Stats(webapp2.RequestHandler):
+
+    def get(self):
+        """Returns the request statistics of this instance. Only accessible by admins."""
+        if not is_admin(self.request):
+            self.response.set_status(403)
+            self.response.write("Forbidden - Only accessible by administrators")
+            return
+
+        result = stats.snapshot()
+        if speakap_api.speakap_api.response_cache:
+            result["response_cache"] = speakap_api.speakap_api.response_cache.stats()
+        if STORAGE_BACKEND == "datastore" and WRITE_BEHIND_VOTES:
+            # the number of buffered votes and the flush lag, see votebuffer.py
+            result["vote_buffer"] = votebuffer.stats()
+
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.write(json.dumps(result))
 
 
 def handle_404(request, response, exception):
@@ -163,8 +574,20 @@ def handle_500(request, response, exception):
     response.set_status(500)
 
 
-application = webapp2.WSGIApplication([
+app = webapp2.WSGIApplication([
     ("/", MainPage),
+    ("/voters", VoterProfiles),
+    ("/autocomplete", Autocomplete),
+    ("/api/votes", BulkVotes),
+    ("/tasks/flush-votes", FlushVotes),
+    ("/tasks/aggregate-trending", AggregateTrending),
+    ("/tasks/sync-num-voters", SyncNumVoters),
+    ("/tasks/migrate-products", MigrateProducts),
+    ("/_ah/warmup", Warmup),
+    ("/_stats", Stats),
 ], config=config, debug=True)
-application.error_handlers[404] = handle_404
-application.error_handlers[500] = handle_500
+app.error_handlers[404] = handle_404
+app.error_handlers[500] = handle_500
+
+stats.install_rpc_hooks()
+application = stats.StatsMiddleware(app)
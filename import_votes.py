@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+"""
+Imports votes from newline-delimited JSON files, such as exports of other systems.
+
+Every line is a JSON object with productName and userEID properties, and optionally a
+networkEID property, which defaults to --network. Network and user EIDs must be valid EIDs (see
+speakap.EID_PATTERN), as /api/votes rejects any other. Files are read line by line and imported in
+chunks of at most --batch-size votes, so files of any size are imported in bounded memory.
+Chunks are either posted to the /api/votes endpoint of a running app, signed with the app
+secret:
+
+  python import_votes.py --url https://office-supplies.appspot.com votes.jsonl
+
+or written to a SQLite database directly (see storage.SQLiteStorage):
+
+  python import_votes.py --sqlite votes.sqlite votes.jsonl
+
+Chunks are imported by --concurrency threads at once. Progress is reported on stderr every
+--progress-interval seconds. Lines that aren't valid votes are skipped and counted, and chunks
+that still fail after --retries attempts are logged. The exit status is 1 if any vote could not
+be imported.
+
+As casting a vote is idempotent, an interrupted import can simply be restarted.
+"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import Queue
+import sys
+import threading
+import time
+import urllib2
+
+from datetime import datetime
+from urllib import urlencode
+
+import speakap
+import speakap_api
+import storage
+
+
+DEFAULT_BATCH_SIZE = 500 # at most MAX_BULK_VOTES of example-app.py
+
+DEFAULT_CONCURRENCY = 8
+
+DEFAULT_RETRIES = 3
+
+DEFAULT_PROGRESS_INTERVAL = 5 # seconds
+
+TIMEOUT = 60 # seconds
+
+
+def read_votes(lines, default_network_eid, progress):
+    """
+    Parses votes from lines of JSON.
+
+    @return Iterator over (network EID, product name, user EID) tuples. Invalid lines are
+            counted as skipped.
+    """
+    for (number, line) in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            vote = json.loads(line)
+            network_eid = vote.get("networkEID", default_network_eid)
+            (product_name, user_eid) = (vote["productName"], vote["userEID"])
+            if not (isinstance(product_name, basestring)
+                    and all(isinstance(eid, basestring) and speakap.EID_PATTERN.match(eid)
+                            for eid in (user_eid, network_eid))):
+                raise ValueError("Invalid vote")
+        except (AttributeError, KeyError, ValueError), exception:
+            logging.warning("Skipping line %d: %s", number, exception)
+            progress.add(skipped=1)
+            continue
+        yield (network_eid, product_name, user_eid)
+
+def chunks(votes, batch_size):
+    """
+    Groups consecutive votes of the same network into chunks.
+
+    @return Iterator over (network EID, list of (product name, user EID) tuples) tuples, with at
+            most batch_size votes each.
+    """
+    (network_eid, chunk) = (None, [])
+    for (vote_network_eid, product_name, user_eid) in votes:
+        if chunk and (vote_network_eid != network_eid or len(chunk) >= batch_size):
+            yield (network_eid, chunk)
+            chunk = []
+        network_eid = vote_network_eid
+        chunk.append((product_name, user_eid))
+    if chunk:
+        yield (network_eid, chunk)
+
+
+class APIImporter:
+    """Posts votes to the /api/votes endpoint of the app."""
+
+    def __init__(self, url, app_secret):
+        self.url = url.rstrip("/") + "/api/votes"
+        self.app_secret = app_secret
+
+    def cast_votes(self, network_eid, votes):
+        """Returns the number of votes that were counted."""
+        body = json.dumps({ "votes": [{ "productName": product_name, "userEID": user_eid }
+                                      for (product_name, user_eid) in votes] })
+        params = {
+            "bodyDigest": base64.b64encode(hashlib.sha256(body).digest()),
+            "issuedAt": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.000000+00:00"),
+            "networkEID": network_eid
+        }
+        params["signature"] = base64.b64encode(
+            hmac.new(self.app_secret, speakap.signed_request(params), hashlib.sha256).digest())
+
+        request = urllib2.Request(self.url + "?" + urlencode(params), body,
+                                  { "Content-Type": "application/json" })
+        response = urllib2.urlopen(request, timeout=TIMEOUT)
+        try:
+            return json.load(response)["numCounted"]
+        finally:
+            response.close()
+
+
+class StorageImporter:
+    """Writes votes to a storage backend directly."""
+
+    def __init__(self, product_storage):
+        self.storage = product_storage
+
+    def cast_votes(self, network_eid, votes):
+        """Returns the number of votes that were counted."""
+        return self.storage.cast_votes(network_eid, votes).count(True)
+
+
+class Progress:
+    """
+    Counts imported votes and reports them every interval seconds.
+
+    Instances are safe to use from multiple threads.
+    """
+
+    def __init__(self, interval, output=sys.stderr):
+        self.interval = interval
+        self.output = output
+        self.imported = 0
+        self.counted = 0
+        self.skipped = 0
+        self.failed = 0
+
+        self._started_at = time.time()
+        self._reported_at = self._started_at
+        self._lock = threading.Lock()
+
+    def add(self, imported=0, counted=0, skipped=0, failed=0):
+        with self._lock:
+            self.imported += imported
+            self.counted += counted
+            self.skipped += skipped
+            self.failed += failed
+
+            now = time.time()
+            if now - self._reported_at >= self.interval:
+                self._reported_at = now
+                self._report(now)
+
+    def finish(self):
+        with self._lock:
+            self._report(time.time())
+
+    def _report(self, now):
+        duration = max(now - self._started_at, 0.001)
+        print >> self.output, "%d votes imported (%d counted, %d skipped, %d failed) in %.1fs, " \
+            "%.0f votes/s" % (self.imported, self.counted, self.skipped, self.failed, duration,
+                              self.imported / duration)
+
+
+def import_chunks(importer, chunks, progress, concurrency, retries):
+    """
+    Imports chunks of votes using concurrency threads.
+
+    At most twice as many chunks as there are threads are read ahead, so memory use doesn't
+    depend on the number of votes.
+    """
+    pending = Queue.Queue(maxsize=concurrency * 2)
+
+    def work():
+        while True:
+            chunk = pending.get()
+            if chunk is None:
+                return
+            (network_eid, votes) = chunk
+            for attempt in range(retries):
+                try:
+                    counted = importer.cast_votes(network_eid, votes)
+                except Exception, exception:
+                    logging.warning("Importing %d votes failed (attempt %d of %d): %s",
+                                    len(votes), attempt + 1, retries, exception)
+                    time.sleep(2 ** attempt)
+                    continue
+                progress.add(imported=len(votes), counted=counted)
+                break
+            else:
+                logging.error("Could not import %d votes of network %s: %s",
+                              len(votes), network_eid, json.dumps(votes))
+                progress.add(failed=len(votes))
+
+    threads = [threading.Thread(target=work) for index in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for chunk in chunks:
+            pending.put(chunk)
+    finally:
+        for thread in threads:
+            pending.put(None)
+        for thread in threads:
+            thread.join()
+
+def main():
+    parser = argparse.ArgumentParser(description="Imports votes from JSONL files.")
+    parser.add_argument("files", nargs="*", help="files to import, stdin by default")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="base URL of the app to post the votes to")
+    target.add_argument("--sqlite", help="SQLite database to write the votes to")
+    parser.add_argument("--app-secret", default=speakap_api.SPEAKAP_APP_SECRET,
+                        help="secret to sign the requests with")
+    parser.add_argument("--network", help="network EID of votes without a networkEID")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="maximum number of votes per request (default 500)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="number of chunks imported at once (default 8)")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES,
+                        help="number of attempts per chunk (default 3)")
+    parser.add_argument("--progress-interval", type=float, default=DEFAULT_PROGRESS_INTERVAL,
+                        help="seconds between progress reports (default 5)")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(levelname)s %(message)s")
+
+    if args.url:
+        importer = APIImporter(args.url, args.app_secret)
+    else:
+        importer = StorageImporter(storage.SQLiteStorage(args.sqlite))
+
+    def lines():
+        if not args.files:
+            for line in sys.stdin:
+                yield line
+        for path in args.files:
+            with open(path) as input:
+                for line in input:
+                    yield line
+
+    progress = Progress(args.progress_interval)
+    votes = read_votes(lines(), args.network, progress)
+    import_chunks(importer, chunks(votes, args.batch_size), progress,
+                  args.concurrency, args.retries)
+    progress.finish()
+
+    if progress.failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
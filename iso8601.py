@@ -13,12 +13,19 @@ from datetime import (
     timedelta,
     tzinfo
 )
+from collections import OrderedDict
 from decimal import Decimal
 import logging
 import sys
 import re
+import threading
 
-__all__ = ["parse_date", "ParseError"]
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ["parse_date", "parse_dates", "set_cache_size", "ParseError"]
 
 LOG = logging.getLogger(__name__)
 
@@ -73,6 +80,8 @@ ISO8601_REGEX = re.compile(
     re.VERBOSE
 )
 
+_DIGITS = "0123456789"
+
 class ParseError(Exception):
     """Raised when there is a problem parsing a date string"""
 
@@ -129,6 +138,24 @@ class FixedOffset(tzinfo):
     def __repr__(self):
         return "<FixedOffset %r %r>" % (self.__name, self.__offset)
 
+_FIXED_OFFSETS = {}
+
+def fixed_offset(sign, hours, minutes):
+    """Returns a shared FixedOffset instance for the given offset
+
+    :param sign: Either "+" or "-"
+
+    """
+    key = (sign, hours, minutes)
+    offset = _FIXED_OFFSETS.get(key)
+    if offset is None:
+        description = "%s%02d:%02d" % (sign, hours, minutes)
+        if sign == "-":
+            hours = -hours
+            minutes = -minutes
+        offset = _FIXED_OFFSETS.setdefault(key, FixedOffset(hours, minutes, description))
+    return offset
+
 def to_int(d, key, default_to_zero=False, default=None, required=True):
     """Pull a value from the dict and convert to int
 
@@ -161,11 +188,72 @@ def parse_timezone(matches, default_timezone=UTC):
     sign = matches["tz_sign"]
     hours = to_int(matches, "tz_hour")
     minutes = to_int(matches, "tz_minute", default_to_zero=True)
-    description = "%s%02d:%02d" % (sign, hours, minutes)
-    if sign == "-":
-        hours = -hours
-        minutes = -minutes
-    return FixedOffset(hours, minutes, description)
+    return fixed_offset(sign, hours, minutes)
+
+def parse_canonical_date(datestring, default_timezone=UTC):
+    """Parses dates of the form YYYY-MM-DDTHH:MM:SS[.ffffff][Z|+HH:MM]
+
+    This is the most common form of ISO 8601 dates, which is parsed by slicing
+    the string at fixed offsets rather than by matching the full regular
+    expression. Returns None if the date string is not of this form, in which
+    case it may still be a valid ISO 8601 date.
+    """
+    length = len(datestring)
+    if length < 19 or datestring[4] != "-" or datestring[7] != "-" or \
+       datestring[10] not in ("T", " ") or datestring[13] != ":" or datestring[16] != ":":
+        return None
+    digits = (datestring[0:4] + datestring[5:7] + datestring[8:10] +
+              datestring[11:13] + datestring[14:16] + datestring[17:19])
+    if digits.strip(_DIGITS):
+        return None
+
+    position = 19
+    microsecond = 0
+    if position < length and datestring[position] == ".":
+        end = position + 1
+        while end < length and datestring[end] in _DIGITS:
+            end += 1
+        fraction = datestring[position + 1:end]
+        # very long fractions are rounded by the Decimal arithmetic of the
+        # regular path, so leave those to it
+        if not fraction or len(fraction) > 20:
+            return None
+        microsecond = int(fraction[:6].ljust(6, "0"))
+        position = end
+
+    timezone = datestring[position:]
+    if not timezone:
+        tz = default_timezone
+    elif timezone == "Z":
+        tz = UTC
+    elif len(timezone) == 6 and timezone[0] in ("+", "-") and timezone[3] == ":" and \
+         not (timezone[1:3] + timezone[4:6]).strip(_DIGITS):
+        tz = fixed_offset(timezone[0], int(timezone[1:3]), int(timezone[4:6]))
+    else:
+        return None
+
+    try:
+        return datetime(int(digits[0:4]), int(digits[4:6]), int(digits[6:8]),
+                        int(digits[8:10]), int(digits[10:12]), int(digits[12:14]),
+                        microsecond, tz)
+    except Exception as e:
+        raise ParseError(e)
+
+_cache = None
+_cache_size = 0
+_cache_lock = threading.Lock()
+
+def set_cache_size(size):
+    """Enables caching of the results of parse_date()
+
+    Up to size parsed date strings are kept, evicting the least recently used
+    ones first. Only dates parsed using the default timezone UTC are cached. A
+    size of 0 disables the cache, which is the default.
+    """
+    global _cache, _cache_size
+    with _cache_lock:
+        _cache = OrderedDict() if size > 0 else None
+        _cache_size = size
 
 def parse_date(datestring, default_timezone=UTC):
     """Parses ISO 8601 dates into datetime objects
@@ -177,6 +265,27 @@ def parse_date(datestring, default_timezone=UTC):
     """
     if not isinstance(datestring, _basestring):
         raise ParseError("Expecting a string %r" % datestring)
+
+    cache = _cache
+    if cache is not None and default_timezone is UTC:
+        with _cache_lock:
+            result = cache.pop(datestring, None)
+            if result is not None:
+                cache[datestring] = result
+                return result
+
+    result = parse_canonical_date(datestring, default_timezone)
+    if result is None:
+        result = _parse_date(datestring, default_timezone)
+
+    if cache is not None and default_timezone is UTC:
+        with _cache_lock:
+            cache[datestring] = result
+            while len(cache) > _cache_size:
+                cache.popitem(last=False)
+    return result
+
+def _parse_date(datestring, default_timezone):
     m = ISO8601_REGEX.match(datestring)
     if not m:
         raise ParseError("Unable to parse date string %r" % datestring)
@@ -200,3 +309,137 @@ def parse_date(datestring, default_timezone=UTC):
         )
     except Exception as e:
         raise ParseError(e)
+
+# positions of the digits in YYYY-MM-DDTHH:MM:SS
+_CANONICAL_DIGITS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+
+def parse_dates(datestrings, default_timezone=UTC, with_offsets=False):
+    """Parses a sequence of ISO 8601 dates into a NumPy datetime64 array
+
+    Dates of the form YYYY-MM-DDTHH:MM:SS[.ffffff][Z|+HH:MM] are parsed using
+    vectorized operations on the whole batch, other dates are parsed one by
+    one using parse_date(). Requires NumPy 1.7 or higher.
+
+    :param datestrings: Iterable of date strings
+    :param default_timezone: Timezone of dates without a timezone
+    :param with_offsets: Whether to return the UTC offsets of the dates
+
+    Returns a tuple (dates, errors), or (dates, offsets, errors) if
+    with_offsets is True. dates is a datetime64[us] array containing the
+    dates in UTC, offsets is a timedelta64[m] array containing the UTC offsets
+    of the dates and errors is a dictionary mapping the index of every date
+    that could not be parsed to its ParseError. Dates that could not be parsed
+    are NaT.
+
+    """
+    if numpy is None:
+        raise ImportError("parse_dates() requires NumPy")
+
+    datestrings = list(datestrings)
+    count = len(datestrings)
+    dates = numpy.empty(count, dtype="M8[us]")
+    dates[:] = numpy.datetime64("NaT")
+    offsets = numpy.zeros(count, dtype="m8[m]")
+    errors = {}
+
+    encoded = []
+    for datestring in datestrings:
+        try:
+            encoded.append(datestring.encode("ascii"))
+        except (AttributeError, UnicodeError):
+            encoded.append(b"")
+    lengths = numpy.array([len(datestring) for datestring in encoded], dtype=numpy.int64)
+    width = max([20] + [len(datestring) for datestring in encoded])
+    chars = numpy.array(encoded, dtype="S%d" % width).view(numpy.uint8).reshape(count, width)
+    is_digit = (chars >= ord("0")) & (chars <= ord("9"))
+    values = chars.astype(numpy.int64) - ord("0")
+    rows = numpy.arange(count)
+
+    def char_at(position):
+        return chars[rows, numpy.minimum(position, width - 1)]
+
+    def digit_at(position):
+        return values[rows, numpy.minimum(position, width - 1)]
+
+    canonical = ((lengths >= 19) & (chars[:, 4] == ord("-")) & (chars[:, 7] == ord("-")) &
+                 ((chars[:, 10] == ord("T")) | (chars[:, 10] == ord(" "))) &
+                 (chars[:, 13] == ord(":")) & (chars[:, 16] == ord(":")) &
+                 is_digit[:, _CANONICAL_DIGITS].all(axis=1))
+
+    # fractions are followed by the timezone, which doesn't start with a digit
+    has_fraction = chars[:, 19] == ord(".")
+    fraction_length = numpy.where(
+        has_fraction, numpy.cumprod(is_digit[:, 20:], axis=1).sum(axis=1), 0)
+    canonical &= ~has_fraction | ((fraction_length >= 1) & (fraction_length <= 20))
+    microsecond = numpy.zeros(count, dtype=numpy.int64)
+    for index in range(6):
+        microsecond = microsecond * 10 + numpy.where(
+            index < fraction_length, digit_at(20 + index), 0)
+
+    timezone = numpy.where(has_fraction, 20 + fraction_length, 19)
+    timezone_length = lengths - timezone
+    utc = (timezone_length == 1) & (char_at(timezone) == ord("Z"))
+    fixed = ((timezone_length == 6) &
+             ((char_at(timezone) == ord("+")) | (char_at(timezone) == ord("-"))) &
+             (char_at(timezone + 3) == ord(":")))
+    for index in (1, 2, 4, 5):
+        fixed &= (char_at(timezone + index) >= ord("0")) & (char_at(timezone + index) <= ord("9"))
+    offset_hours = digit_at(timezone + 1) * 10 + digit_at(timezone + 2)
+    offset_minutes = digit_at(timezone + 4) * 10 + digit_at(timezone + 5)
+    # offsets of a day or more are rejected when converting to UTC, which is
+    # left to parse_date() so the error is reported the same way
+    fixed &= (offset_hours < 24) & (offset_minutes < 60)
+    offset = numpy.where(char_at(timezone) == ord("-"), -1, 1) * (offset_hours * 60 + offset_minutes)
+
+    try:
+        default_offset = default_timezone.utcoffset(None)
+    except Exception:
+        default_offset = None
+    if default_offset is not None:
+        default = timezone_length == 0
+        offset = numpy.where(default, int(default_offset.days * 1440 + default_offset.seconds // 60), offset)
+        canonical &= utc | fixed | default
+    else:
+        canonical &= utc | fixed
+    offset = numpy.where(utc, 0, offset)
+
+    def number(*positions):
+        result = numpy.zeros(count, dtype=numpy.int64)
+        for position in positions:
+            result = result * 10 + values[:, position]
+        return result
+
+    year = number(0, 1, 2, 3)
+    month = number(5, 6)
+    day = number(8, 9)
+    hour = number(11, 12)
+    minute = number(14, 15)
+    second = number(17, 18)
+    canonical &= ((year >= 1) & (month >= 1) & (month <= 12) & (day >= 1) &
+                  (hour < 24) & (minute < 60) & (second < 60))
+
+    months = numpy.where(canonical, (year - 1970) * 12 + month - 1, 0)
+    month_start = months.astype("M8[M]").astype("M8[D]")
+    days_in_month = ((months + 1).astype("M8[M]").astype("M8[D]") - month_start).astype(numpy.int64)
+    canonical &= day <= days_in_month
+
+    local = (month_start.astype("M8[us]") +
+             (((day - 1) * 24 + hour) * 60 + minute).astype("m8[m]") +
+             second.astype("m8[s]") + microsecond.astype("m8[us]"))
+    dates[canonical] = (local - offset.astype("m8[m]"))[canonical]
+    offsets[canonical] = offset.astype("m8[m]")[canonical]
+
+    for index in numpy.flatnonzero(~canonical):
+        try:
+            date = parse_date(datestrings[index], default_timezone=default_timezone)
+            utcoffset = date.utcoffset() or ZERO
+            dates[index] = numpy.datetime64(date.replace(tzinfo=None) - utcoffset, "us")
+            offsets[index] = numpy.timedelta64(utcoffset.days * 1440 + utcoffset.seconds // 60, "m")
+        except ParseError as e:
+            errors[int(index)] = e
+        except Exception as e:
+            errors[int(index)] = ParseError(e)
+
+    if with_offsets:
+        return (dates, offsets, errors)
+    return (dates, errors)
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+
+"""
+Materialized top-N ranking of products.
+
+The ranking shown on the overview is kept in memcache as a list of entries, each containing the
+product name, its vote count and a preview of its voters. Every vote updates the cached ranking
+incrementally using compare-and-set, so concurrent instances never overwrite each other's
+updates. If an update keeps failing, the cached ranking is dropped rather than risking a
+corrupted one.
+
+The datastore query only runs when the cached ranking is missing or has expired. The ranking
+expires CACHE_TIME seconds after it was built, regardless of the number of incremental updates,
+which reconciles any drift with the datastore periodically. In addition, the ranking is written
+to a LeaderboardSnapshot entity every SNAPSHOT_INTERVAL seconds, so that a memcache flush can be
+bridged without all instances querying the datastore at once.
+
+Products beyond the top-N are paged through by their position in the ranking, see get_page().
+A cursor encodes the number of voters and name of the last product of the previous page, so it
+doesn't depend on the query the cached ranking was built from, and votes moving products into
+the top-N simply update the cached ranking.
+
+Every change to the rankings bumps a version counter in memcache, see get_version(), so pages
+rendered from the rankings can be cached and revalidated until the version changes.
+
+The memcache key and the snapshot carry a FORMAT_VERSION, which must be bumped whenever the
+format of the entries changes, so instances running different versions never read each other's
+rankings.
+"""
+
+import base64
+import json
+import time
+
+import counters
+import models
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+
+SIZE = 20
+
+PREVIEW_SIZE = counters.PREVIEW_SIZE
+
+CACHE_TIME = 300 # seconds
+
+SNAPSHOT_INTERVAL = 30 # seconds
+
+SNAPSHOT_MAX_AGE = 120 # seconds
+
+FORMAT_VERSION = 3
+
+CAS_RETRIES = 5
+
+CACHE_KEY = "leaderboard:v%d" % FORMAT_VERSION
+
+VERSION_KEY = "leaderboard-version"
+
+
+class LeaderboardSnapshot(db.Model):
+    entries = db.TextProperty()
+    generation = db.IntegerProperty(default=0, indexed=False)
+    format_version = db.IntegerProperty(default=FORMAT_VERSION, indexed=False)
+    built_at = db.FloatProperty(indexed=False)
+    updated_at = db.FloatProperty(indexed=False)
+
+
+def get_top_page():
+    """
+    Returns the ranked top-N products, as the first page of the ranking.
+
+    @return (entries, cursor) tuple, where entries is the list of entries ordered by number of
+            voters, and cursor is the cursor of the next page to pass to get_page(), or None if
+            there is none. Every entry is a dictionary with name, key, num_voters and voters
+            properties, where voters contains at most PREVIEW_SIZE EIDs.
+    """
+    ranking = memcache.get(CACHE_KEY)
+    if ranking is None:
+        ranking = _load_snapshot() or _build()
+        memcache.add(CACHE_KEY, ranking, time=_remaining_time(ranking))
+    return (ranking["entries"], _encode_cursor(ranking["entries"]))
+
+def get_page(cursor):
+    """
+    Returns a page of the ranking following the top-N products.
+
+    @param cursor Cursor of the page, as returned by get_top_page() or get_page().
+
+    @return (entries, cursor) tuple, where entries contains at most SIZE entries in the same
+            format as returned by get_top_page(), and cursor is the cursor of the next page or None
+            if there is none.
+
+    The products are loaded using two projection queries, one for the products tied with the
+    last product of the previous page and one for the products ranked below them, and the voter
+    previews using a single batch get, so the cost of a page doesn't depend on how deep it is or
+    on the number of voters. The vote counts are the denormalized totals, see counters.py.
+
+    Raises a ValueError if the cursor is invalid.
+    """
+    (num_voters, name) = _decode_cursor(cursor)
+    # requires the composite indexes in index.yaml
+    query = db.Query(models.Product, projection=("name", "num_voters"))
+    query.filter("num_voters =", num_voters).filter("name >", name).order("name")
+    products = query.fetch(limit=SIZE)
+    if len(products) < SIZE:
+        query = _ranking_query().filter("num_voters <", num_voters)
+        products.extend(query.fetch(limit=SIZE - len(products)))
+
+    previews = counters.load_previews([product.key() for product in products])
+    entries = [{
+        "key": str(product.key()),
+        "name": product.name,
+        "num_voters": product.num_voters,
+        "voters": voters
+    } for (product, voters) in zip(products, previews)]
+    return (entries, _encode_cursor(entries))
+
+def get_version():
+    """
+    Returns the version of the rankings, which changes whenever a vote is counted or a ranking
+    is rebuilt.
+
+    Versions start at the current time in milliseconds, so they keep increasing even if the
+    counter is evicted from memcache.
+    """
+    version = memcache.get(VERSION_KEY)
+    if version is None:
+        memcache.add(VERSION_KEY, int(time.time() * 1000))
+        version = memcache.get(VERSION_KEY)
+    return version
+
+def bump_version(namespace=None):
+    """
+    Changes the version of the rankings, see get_version().
+
+    @param namespace Namespace of the rankings, by default the current namespace.
+    """
+    memcache.incr(VERSION_KEY, initial_value=int(time.time() * 1000), namespace=namespace)
+
+def record_vote(product, user_eid):
+    """
+    Incrementally updates the cached ranking after a vote has been counted.
+
+    @param product The Product entity that was voted on.
+    @param user_eid EID of the user that voted.
+    """
+    record_votes(product, [user_eid])
+
+def record_votes(product, user_eids):
+    """
+    Incrementally updates the cached ranking after votes have been counted.
+
+    @param product The Product entity that was voted on.
+    @param user_eids List of EIDs of the users whose votes were counted.
+    """
+    record_batch([(product, user_eids)])
+
+def record_batch(votes):
+    """
+    Incrementally updates the cached ranking after votes on multiple products have been counted,
+    using a single compare-and-set.
+
+    @param votes List of (product, user EIDs) tuples, where product is a Product entity that was
+                 voted on and user EIDs is the list of EIDs of the users whose votes were counted.
+    """
+    try:
+        _record_votes(votes)
+    finally:
+        bump_version()
+
+def _record_votes(votes):
+    client = memcache.Client()
+    loaded = set()
+
+    def load_counts(products):
+        unloaded = [product for product in products if product.key() not in loaded]
+        if unloaded:
+            counters.load_counts(unloaded)
+            loaded.update(product.key() for product in unloaded)
+
+    for attempt in range(CAS_RETRIES):
+        ranking = client.gets(CACHE_KEY)
+        if ranking is None:
+            # the rebuilt ranking already includes the votes, as the counts are read from the
+            # shards, but the ranking query may not reflect the new totals of the products yet
+            ranking = _build()
+            products = [product for (product, user_eids) in votes]
+            load_counts(products)
+            inserted = [product for product in products if _insert(ranking["entries"], product)]
+            if inserted:
+                _save_snapshot(ranking)
+            memcache.add(CACHE_KEY, ranking, time=_remaining_time(ranking))
+            return
+
+        entries = ranking["entries"]
+        ranked = dict((entry["key"], entry) for entry in entries)
+        unranked = []
+        for (product, user_eids) in votes:
+            entry = ranked.get(str(product.key()))
+            if entry:
+                entry["num_voters"] += len(user_eids)
+                entry["voters"].extend(user_eids[:max(0, PREVIEW_SIZE - len(entry["voters"]))])
+            else:
+                unranked.append(product)
+        entries.sort(key=_rank)
+
+        load_counts(unranked)
+        inserted = [product for product in unranked if _insert(entries, product)]
+        if not inserted and len(unranked) == len(votes):
+            return
+
+        ranking["generation"] += 1
+        if client.cas(CACHE_KEY, ranking, time=_remaining_time(ranking)):
+            if memcache.add("leaderboard-snapshot", 1, time=SNAPSHOT_INTERVAL):
+                _save_snapshot(ranking)
+            return
+
+    client.delete(CACHE_KEY)
+
+def _build():
+    # the complete products are needed to load their exact counts
+    product_keys = [product.key() for product in _ranking_query().fetch(limit=SIZE)]
+    products = [product for product in db.get(product_keys) if product]
+    counters.load_counts(products)
+
+    entries = [_entry(product) for product in products]
+    entries.sort(key=_rank)
+
+    snapshot = LeaderboardSnapshot.get_by_key_name("top")
+    ranking = {
+        "generation": snapshot.generation + 1 if snapshot else 1,
+        "built_at": time.time(),
+        "entries": entries
+    }
+    _save_snapshot(ranking)
+    bump_version()
+    return ranking
+
+def _decode_cursor(cursor):
+    try:
+        (num_voters, name) = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        return (int(num_voters), unicode(name))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor: %s" % cursor)
+
+def _encode_cursor(entries):
+    # the cursor is the position of the last entry of the page, so pages never skip or repeat
+    # products while votes are cast, except for products that move across the page boundary
+    if len(entries) < SIZE:
+        return None
+    last = entries[-1]
+    return base64.urlsafe_b64encode(json.dumps([last["num_voters"], last["name"]]))
+
+def _entry(product):
+    return {
+        "key": str(product.key()),
+        "name": product.name,
+        "num_voters": product.num_voters,
+        "voters": product.voters
+    }
+
+def _insert(entries, product):
+    """
+    Inserts the product into the entries if it isn't ranked yet, but should be.
+
+    The counts of the product should have been loaded using counters.load_counts().
+    """
+    product_key = str(product.key())
+    if any(entry["key"] == product_key for entry in entries):
+        return False
+
+    if len(entries) >= SIZE and product.num_voters <= entries[-1]["num_voters"]:
+        return False
+
+    entries.append(_entry(product))
+    entries.sort(key=_rank)
+    del entries[SIZE:]
+    return True
+
+def _load_snapshot():
+    snapshot = LeaderboardSnapshot.get_by_key_name("top")
+    if not snapshot or snapshot.format_version != FORMAT_VERSION or \
+       snapshot.updated_at < time.time() - SNAPSHOT_MAX_AGE or \
+       _remaining_time({ "built_at": snapshot.built_at }) <= 1:
+        return None
+
+    return {
+        "generation": snapshot.generation,
+        "built_at": snapshot.built_at,
+        "entries": json.loads(snapshot.entries)
+    }
+
+def _rank(entry):
+    return (-entry["num_voters"], entry["name"])
+
+def _ranking_query():
+    # requires the composite index in index.yaml. ties are ranked by name, like _rank()
+    query = db.Query(models.Product, projection=("name", "num_voters"))
+    return query.order("-num_voters").order("name")
+
+def _remaining_time(ranking):
+    return max(1, int(ranking["built_at"] + CACHE_TIME - time.time()))
+
+def _save_snapshot(ranking):
+    LeaderboardSnapshot(key_name="top",
+                        entries=json.dumps(ranking["entries"]),
+                        generation=ranking["generation"],
+                        built_at=ranking["built_at"],
+                        updated_at=time.time()).put()
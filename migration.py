@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""
+Migration of products from before products were keyed by their normalized name.
+
+These products have numeric IDs, are kept in the default namespace, as they predate the
+partitioning per network (see storage.DatastoreStorage), and list their voters in
+Product.voters, or in VoteShard entities keyed by the string representation of the product key.
+The app reads neither, so these products and their votes are lost until they are migrated.
+
+migrate_products() moves them to the namespace of a network: the voters of every legacy product
+are cast as votes on the keyed product with the same name, after which the legacy product and its
+shards are deleted. The votes are counted in the ranking, but not in the trending ranking, as the
+time they were cast is unknown. Casting a vote is idempotent, so a migration that fails halfway
+can simply be run again.
+"""
+
+import logging
+import time
+
+import counters
+import leaderboard
+import models
+
+from google.appengine.api import namespace_manager
+from google.appengine.ext import db
+
+
+BATCH_SIZE = 50
+
+# the migration is run by hand rather than by cron or a task, so it must finish well within the
+# 60 second deadline of front-end requests
+MIGRATE_DEADLINE = 40 # seconds
+
+# the number of shards products had before products were keyed by name
+LEGACY_NUM_SHARDS = 10
+
+
+def migrate_products(network_eid, index_prefixes=False):
+    """
+    Migrates the products with numeric IDs in the default namespace to the namespace of a network.
+
+    Keeps migrating batches of products until all products are migrated or MIGRATE_DEADLINE is
+    exceeded.
+
+    @param network_eid EID of the network to migrate the products to.
+    @param index_prefixes Whether created products store the prefixes of the words of their
+           name, see storage.DatastoreStorage.
+
+    @return Dictionary with the numbers of migrated products and counted votes, and whether all
+            products have been migrated.
+    """
+    start = time.time()
+    num_products = 0
+    num_votes = 0
+    done = False
+
+    while time.time() - start < MIGRATE_DEADLINE:
+        # keys with numeric IDs are ordered before keys with names
+        query = db.Query(models.Product, namespace="").order("__key__")
+        products = [product for product in query.fetch(BATCH_SIZE) if product.key().id()]
+        if not products:
+            done = True
+            break
+
+        for product in products:
+            num_votes += _migrate_product(product, network_eid, index_prefixes)
+            num_products += 1
+
+    logging.info("Migrated %d products (%d votes) to network %s", num_products, num_votes,
+                 network_eid)
+    return { "num_products": num_products, "num_votes": num_votes, "done": done }
+
+def _migrate_product(legacy_product, network_eid, index_prefixes):
+    shard_keys = [db.Key.from_path("VoteShard", "%s:%d" % (legacy_product.key(), index),
+                                   namespace="")
+                  for index in range(LEGACY_NUM_SHARDS)]
+    voters = list(legacy_product.voters)
+    for shard in db.get(shard_keys):
+        if shard:
+            voters.extend(shard.voters)
+
+    counted = []
+    previous_namespace = namespace_manager.get_namespace()
+    namespace_manager.set_namespace(network_eid)
+    try:
+        product = models.Product.get_or_insert_by_name(legacy_product.name, index_prefixes)
+        if product and voters:
+            counted = counters.cast_votes(product, voters)
+            if counted:
+                leaderboard.record_votes(product, counted)
+    finally:
+        namespace_manager.set_namespace(previous_namespace)
+
+    db.delete([legacy_product.key()] + shard_keys)
+    return len(counted)
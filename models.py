@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import counters
+import storage
+
+from google.appengine.ext import db
+
+
+class Product(db.Model):
+    """
+    Product that can be voted on.
+
+    Products are keyed by their normalized name (see key_name_for()), so looking up the product
+    to vote on is a strongly consistent get by key, and concurrent first votes cannot create
+    duplicate products.
+    """
+
+    name = db.StringProperty(required=True)
+    # voters of products from before products were keyed by name, which are only read by
+    # migration.py. counters.load_counts() replaces it with a preview of the voters
+    voters = db.StringListProperty(indexed=False)
+    # denormalized total of all shards, used for ranking
+    num_voters = db.IntegerProperty(default=0)
+    # number of shards the votes are spread over, which can be raised for hot products, see
+    # counters.py. it's never lowered, as the votes on the dropped shards would no longer count
+    num_shards = db.IntegerProperty(default=counters.DEFAULT_NUM_SHARDS, indexed=False)
+    # prefixes of the words of the name, for autocompletion, see storage.prefix_tokens(). only
+    # stored when enabled, as it's indexed, see storage.DatastoreStorage
+    name_prefixes = db.StringListProperty()
+
+    @classmethod
+    def key_name_for(cls, name):
+        """
+        Returns the key name of the product with the given name.
+
+        Names are normalized using storage.normalize_name(). Returns None if the name is empty
+        after normalization.
+        """
+        key_name = storage.normalize_name(name)
+        # prefixed, as key names of the form __*__ are reserved
+        return ("p:" + key_name) if key_name else None
+
+    @classmethod
+    def get_or_insert_by_name(cls, name, index_prefixes=False):
+        """
+        Returns the product with the given name, creating it if it doesn't exist.
+
+        If index_prefixes is True, a created product stores the prefixes of the words of its name
+        in name_prefixes. Returns None if the name is empty after normalization.
+        """
+        key_name = cls.key_name_for(name)
+        if not key_name:
+            return None
+        name_prefixes = storage.prefix_tokens(name) if index_prefixes else []
+        return cls.get_or_insert(key_name, name=name.strip()[:storage.MAX_NAME_LENGTH],
+                                 name_prefixes=name_prefixes)
+
+    @classmethod
+    def get_or_insert_by_names(cls, names, index_prefixes=False):
+        """
+        Returns the products with the given names, creating the ones that don't exist.
+
+        Like get_or_insert_by_name(), but the existing products are loaded using a single batch
+        get, and the missing ones are created in cross-group transactions of up to
+        counters.MAX_GROUPS_PER_TRANSACTION products each.
+
+        @return List containing the product for every name, or None if the name is empty after
+                normalization.
+        """
+        key_names = [cls.key_name_for(name) for name in names]
+        new_products = {} # key name -> product
+        for (name, key_name) in zip(names, key_names):
+            if key_name and key_name not in new_products:
+                name_prefixes = storage.prefix_tokens(name) if index_prefixes else []
+                new_products[key_name] = cls(key_name=key_name,
+                                             name=name.strip()[:storage.MAX_NAME_LENGTH],
+                                             name_prefixes=name_prefixes)
+
+        products = dict((product.key().name(), product)
+                        for product in cls.get_by_key_name(new_products.keys()) if product)
+        missing = [product for (key_name, product) in new_products.items()
+                   if key_name not in products]
+        for offset in range(0, len(missing), counters.MAX_GROUPS_PER_TRANSACTION):
+            for product in db.run_in_transaction_options(
+                    counters.XG_OPTIONS, _insert_missing,
+                    missing[offset:offset + counters.MAX_GROUPS_PER_TRANSACTION]):
+                products[product.key().name()] = product
+        return [products[key_name] if key_name else None for key_name in key_names]
+
+
+def _insert_missing(products):
+    # returns the stored products, inserting the ones that still don't exist
+    stored = db.get([product.key() for product in products])
+    db.put([product for (product, existing) in zip(products, stored) if existing is None])
+    return [existing or product for (product, existing) in zip(products, stored)]
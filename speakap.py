@@ -7,20 +7,64 @@ import httplib
 import iso8601
 import json
 import logging
-
+import Queue
+import re
+import select
+import socket
+import threading
+import time
+
+from collections import deque
+from collections import OrderedDict
 from datetime import datetime;
 from datetime import timedelta;
 
 try:
+    from google.appengine.api import memcache
     from google.appengine.api import urlfetch
 except ImportError:
+    memcache = None
     urlfetch = None
 
 from urllib import quote
+from urllib import urlencode
 
 
 SIGNATURE_WINDOW_SIZE = 1; # minute
 
+# EIDs of Speakap entities, such as networks and users, are 16 lowercase hexadecimal digits
+EID_PATTERN = re.compile(r"\A[0-9a-f]{16}\Z")
+
+# methods of requests that can safely be sent again when the connection fails
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE")
+
+try:
+    _compare_digest = hmac.compare_digest
+except AttributeError:
+    # Python < 2.7.7
+    def _compare_digest(a, b):
+        if len(a) != len(b):
+            return False
+        result = 0
+        for (x, y) in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
+
+
+class APIError(Exception):
+    """
+    Exception thrown by the iterators of the Speakap API wrapper when a request fails.
+
+    The error property contains the same error object that is returned by the other methods.
+    """
+    def __init__(self, error):
+        self.error = error
+        self.code = error["code"]
+        self.message = error["message"]
+
+    def __str__(self):
+        return "%s (%s)" % (self.message, self.code)
+
 
 class SignatureValidationError(Exception):
     """
@@ -56,6 +100,340 @@ def signed_request(params):
     return query_string
 
 
+class SignatureValidator:
+    """
+    Validator for the signatures of signed requests.
+
+    The HMAC is keyed with the app secret only once, and copied for every signature that is
+    validated. Signatures are compared in constant time.
+
+    Recently validated signatures are kept in a cache of at most cache_size entries, until they
+    expire. Validating the same signed request again while it is cached skips computing the HMAC
+    and parsing the issuedAt timestamp. If reject_replays is True, it raises a
+    SignatureValidationError instead, so every signed request can only be used once.
+
+    Instances are safe to use from multiple threads.
+    """
+    def __init__(self, app_secret, cache_size=1000, reject_replays=False):
+        self.cache_size = cache_size
+        self.reject_replays = reject_replays
+
+        self._hmac = hmac.new(app_secret, digestmod=hashlib.sha256)
+        self._cache = OrderedDict() # signature -> (query_string, expires_at)
+        self._lock = threading.Lock()
+
+    def validate(self, params):
+        """
+        Validates the signature of a signed request.
+
+        @param params Object containing POST parameters passed during the signed request.
+
+        Raises a SignatureValidationError if the signature doesn't match, the signed request is
+        expired or the signed request is replayed while replays are rejected.
+        """
+        if "signature" not in params:
+            raise SignatureValidationError("Parameters did not include a signature")
+
+        signature = params["signature"]
+
+        keys = params.keys()
+        keys.sort()
+        query_string = "&".join(quote(key, "~") + "=" + quote(params[key], "~") \
+                       for key in keys if key != "signature")
+
+        now = datetime.utcnow()
+        with self._lock:
+            cached = self._cache.get(signature)
+        if cached and cached[0] == query_string and now <= cached[1]:
+            if self.reject_replays:
+                raise SignatureValidationError("Replayed signature")
+            return
+
+        digest = self._hmac.copy()
+        digest.update(query_string)
+        if not _compare_digest(base64.b64encode(digest.digest()), str(signature)):
+            raise SignatureValidationError("Invalid signature: " + query_string)
+
+        issued_at = iso8601.parse_date(params["issuedAt"])
+        expires_at = issued_at.replace(tzinfo=None) - issued_at.utcoffset() + \
+                     timedelta(minutes=SIGNATURE_WINDOW_SIZE)
+        if now > expires_at:
+            raise SignatureValidationError("Expired signature")
+
+        with self._lock:
+            if self.reject_replays and signature in self._cache:
+                raise SignatureValidationError("Replayed signature")
+            self._cache[signature] = (query_string, expires_at)
+            self._evict(now)
+
+    def validate_many(self, params_list):
+        """
+        Validates the signatures of multiple signed requests.
+
+        @param params_list List of objects containing the parameters of signed requests.
+
+        @return List containing None for every valid signed request, and the
+                SignatureValidationError for every invalid one, in the same order as the
+                signed requests.
+        """
+        errors = []
+        for params in params_list:
+            try:
+                self.validate(params)
+                errors.append(None)
+            except SignatureValidationError, exception:
+                errors.append(exception)
+        return errors
+
+    def _evict(self, now):
+        # entries are inserted in order of validation, which roughly corresponds to the order of
+        # expiration, so we only need to look at the oldest entries
+        while self._cache:
+            (signature, (query_string, expires_at)) = next(self._cache.iteritems())
+            if expires_at >= now and len(self._cache) <= self.cache_size:
+                break
+            del self._cache[signature]
+
+
+class ConnectionPool:
+    """
+    Pool of persistent HTTP(S) connections.
+
+    Connections are kept alive after a request and reused for subsequent requests to the same
+    host. At most max_size idle connections are kept per host, and connections that have been
+    idle for longer than idle_timeout seconds are closed. Before a connection is reused, it's
+    checked for having been closed by the server, which happens when the server's keep-alive
+    timeout is shorter than idle_timeout. If a request over a reused connection still fails
+    because the server closed the connection in the meantime, the request is retried once over a
+    new connection. Requests that fail after they have been sent are only retried if their method
+    is idempotent, so a POST is never performed twice.
+
+    Instances are safe to use from multiple threads; a connection is only used by a single
+    thread at a time.
+    """
+    def __init__(self, max_size=10, idle_timeout=60, timeout=None):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self._idle = {} # (scheme, hostname) -> list of (connection, last_used)
+        self._lock = threading.Lock()
+
+    def request(self, scheme, hostname, method, path, data=None, headers={}):
+        """
+        Performs a request over a pooled connection.
+
+        @return A tuple containing the status code, body and headers of the response.
+        """
+        (connection, reused) = self._acquire(scheme, hostname)
+        sent = False
+        try:
+            connection.request(method, path, data, headers)
+            sent = True
+            (status, data, headers, will_close) = self._receive(connection)
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            # a request that may have reached the server is only sent again if repeating it is
+            # harmless
+            if not reused or (sent and method not in IDEMPOTENT_METHODS):
+                raise
+            connection = self._create(scheme, hostname)
+            try:
+                (status, data, headers, will_close) = self._send(connection, method, path, data,
+                                                                 headers)
+            except:
+                connection.close()
+                raise
+        except:
+            connection.close()
+            raise
+
+        if will_close:
+            connection.close()
+        else:
+            self._release(scheme, hostname, connection)
+        return (status, data, headers)
+
+    def close(self):
+        """Closes all idle connections."""
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for connections in idle.values():
+            for (connection, last_used) in connections:
+                connection.close()
+
+    def _acquire(self, scheme, hostname):
+        with self._lock:
+            connections = self._idle.get((scheme, hostname), [])
+            threshold = time.time() - self.idle_timeout
+            expired = [connection for (connection, last_used) in connections
+                       if last_used < threshold]
+            connections[:] = [(connection, last_used) for (connection, last_used) in connections
+                              if last_used >= threshold]
+
+        for expired_connection in expired:
+            expired_connection.close()
+
+        while True:
+            with self._lock:
+                connection = connections.pop()[0] if connections else None
+            if connection is None:
+                return (self._create(scheme, hostname), False)
+            if not _is_dropped(connection):
+                return (connection, True)
+            connection.close()
+
+    def _create(self, scheme, hostname):
+        if scheme == "https":
+            return httplib.HTTPSConnection(hostname, timeout=self.timeout)
+        else:
+            return httplib.HTTPConnection(hostname, timeout=self.timeout)
+
+    def _release(self, scheme, hostname, connection):
+        with self._lock:
+            connections = self._idle.setdefault((scheme, hostname), [])
+            if len(connections) < self.max_size:
+                connections.append((connection, time.time()))
+                return
+        connection.close()
+
+    def _send(self, connection, method, path, data, headers):
+        connection.request(method, path, data, headers)
+        return self._receive(connection)
+
+    def _receive(self, connection):
+        response = connection.getresponse()
+        return (response.status, response.read(), dict(response.getheaders()), response.will_close)
+
+
+def _is_dropped(connection):
+    # an idle connection is only readable if the server closed it, or sent something it shouldn't
+    # have, in which case the connection can't be used either
+    if connection.sock is None:
+        return True
+    try:
+        return bool(select.select([connection.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+
+class ResponseCache:
+    """
+    Cache for the replies of GET requests to the Speakap API.
+
+    Only paths matching one of the rules are cached. Every rule is a tuple containing a regular
+    expression and the number of seconds a reply to a matching path is considered fresh; the
+    first matching rule applies.
+
+    Replies are kept in an in-process LRU cache of at most max_size entries and, on Google App
+    Engine, in memcache as a second tier shared by all instances. Once a reply is no longer fresh,
+    it is kept for another stale_time seconds, so the request can be made conditional using its
+    ETag. If the reply hasn't changed, the API replies with a 304 and the cached reply is reused.
+
+    Cached replies are shared between callers, so they should not be modified.
+
+    Replies are invalidated when a POST, PUT or DELETE request is made to the same path through
+    the same API instance. Locally, this invalidates the path including any query parameters,
+    while in memcache only the path itself and the path without query parameters are
+    invalidated.
+
+    The hits, misses and revalidations counters track the effectiveness of the cache; misses
+    include revalidations.
+
+    Instances are safe to use from multiple threads.
+    """
+    def __init__(self, rules, max_size=1000, stale_time=3600, use_memcache=True):
+        self.rules = [(re.compile(pattern), ttl) for (pattern, ttl) in rules]
+        self.max_size = max_size
+        self.stale_time = stale_time
+        self.use_memcache = use_memcache and memcache is not None
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.invalidations = 0
+
+        self._entries = OrderedDict() # path -> { "result", "etag", "expires_at" }
+        self._lock = threading.Lock()
+
+    def ttl_for(self, path):
+        """Returns the TTL in seconds for replies to the given path, or None if not cached."""
+        for (pattern, ttl) in self.rules:
+            if pattern.match(path):
+                return ttl
+        return None
+
+    def lookup(self, path):
+        """
+        Looks up the cached reply to a path.
+
+        @return The cache entry, a dictionary containing the result, etag and expires_at
+                properties, or None if there is no entry.
+        """
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                self._entries[path] = entry
+        if entry is None and self.use_memcache:
+            entry = memcache.get(self._memcache_key(path))
+            if entry is not None:
+                self._store_locally(path, entry)
+
+        with self._lock:
+            if entry is not None and entry["expires_at"] > time.time():
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry
+
+    def store(self, path, result, etag):
+        """Stores the reply to a path."""
+        ttl = self.ttl_for(path)
+        entry = { "result": result, "etag": etag, "expires_at": time.time() + ttl }
+        self._store_locally(path, entry)
+        if self.use_memcache:
+            memcache.set(self._memcache_key(path), entry, time=ttl + self.stale_time)
+
+    def revalidated(self, path, entry):
+        """Marks a cached reply as fresh again, after the API replied it hasn't changed."""
+        with self._lock:
+            self.revalidations += 1
+        self.store(path, entry["result"], entry["etag"])
+
+    def invalidate(self, path):
+        """Invalidates the cached replies to a path."""
+        resource = path.split("?", 1)[0]
+        with self._lock:
+            self.invalidations += 1
+            for cached_path in self._entries.keys():
+                if cached_path.split("?", 1)[0] == resource:
+                    del self._entries[cached_path]
+        if self.use_memcache:
+            memcache.delete_multi([self._memcache_key(path), self._memcache_key(resource)])
+
+    def stats(self):
+        """Returns a dictionary with the counters and the number of locally cached replies."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "invalidations": self.invalidations,
+                "size": len(self._entries)
+            }
+
+    def _memcache_key(self, path):
+        return "speakap-response:" + hashlib.sha1(path).hexdigest()
+
+    def _store_locally(self, path, entry):
+        with self._lock:
+            self._entries.pop(path, None)
+            self._entries[path] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
 class API:
     """
     Speakap API wrapper
@@ -73,6 +451,22 @@ class API:
       Obviously, MY_APP_ID and MY_APP_SECRET should be replaced with your actual App ID and secret
       (or be constants containing those).
 
+      Outside of Google App Engine, connections to the API are kept alive and reused. The optional
+      "max_connections" (default 10), "idle_timeout" (default 60 seconds) and "timeout" (default
+      none) configuration keys control the connection pool.
+
+      Replies to GET requests can be cached by passing a ResponseCache instance as the optional
+      "response_cache" configuration key, for example:
+
+        "response_cache": Speakap.ResponseCache([
+            (r"/networks/\w+/user/\w+/$", 300),
+            (r"/networks/\w+/branding/", 3600)
+        ])
+
+      The optional "request_hook" configuration key can be set to a function that is called after
+      every request with the method, path, status code (None if the request failed) and duration
+      in seconds, for example to collect statistics.
+
       After you have instantiated the API wrapper, you can perform API calls as follows:
 
         (json_result, error) = speakap_api.get("/networks/%s/user/%s/" % (network_eid, user_eid))
@@ -101,6 +495,15 @@ class API:
 
         self.access_token = "%s_%s" % (self.app_id, self.app_secret)
 
+        self.request_hook = config.get("request_hook")
+        self.response_cache = config.get("response_cache")
+        self.signature_validator = SignatureValidator(self.app_secret)
+
+        # only used when not running on Google App Engine
+        self.connection_pool = ConnectionPool(max_size=config.get("max_connections", 10),
+                                              idle_timeout=config.get("idle_timeout", 60),
+                                              timeout=config.get("timeout"))
+
     def delete(self, path):
         """
         Performs a DELETE request to the Speakap API
@@ -118,9 +521,64 @@ class API:
           else
               ... do something with error ...
         """
+        self._invalidate(path)
         response = self._request("DELETE", path)
         return self._handle_response(response)
 
+    def gather(self, calls, max_concurrency=10):
+        """
+        Performs multiple requests to the Speakap API concurrently.
+
+        @param calls List of tuples containing the method, path and (for POST and PUT requests)
+                     the object representing the JSON object to submit.
+        @param max_concurrency The maximum number of requests that are in flight at once.
+
+        @return A list containing a tuple with the parsed JSON reply and an error object for
+                every call, in the same order as the calls.
+
+        On Google App Engine, the requests are performed as asynchronous URL Fetch calls.
+        Elsewhere, they are performed by up to max_concurrency threads, which share the
+        connection pool. GET requests use the response cache, if configured.
+
+        Example:
+
+          results = speakap_api.gather([
+              ("GET", "/networks/%s/user/%s/" % (network_eid, user_eid)) for user_eid in user_eids
+          ])
+          for (json_result, error) in results:
+              ...
+        """
+        results = [None] * len(calls)
+        entries = {}
+        requests = []
+        indices = []
+        for (index, call) in enumerate(calls):
+            (method, path) = call[:2]
+            if method == "GET":
+                (result, entry, headers) = self._lookup(path)
+                if result:
+                    results[index] = result
+                    continue
+                entries[index] = entry
+            else:
+                self._invalidate(path)
+                headers = None
+            data = json.dumps(call[2]) if len(call) > 2 and call[2] is not None else None
+            requests.append((method, path, data, headers))
+            indices.append(index)
+
+        if urlfetch:
+            responses = self._fetch_many(requests, max_concurrency)
+        else:
+            responses = self._request_many(requests, max_concurrency)
+
+        for (index, request, response) in zip(indices, requests, responses):
+            if index in entries:
+                results[index] = self._handle_get_response(request[1], entries[index], response)
+            else:
+                results[index] = self._handle_response(response)
+        return results
+
     def get(self, path):
         """
         Performs a GET request to the Speakap API
@@ -138,8 +596,69 @@ class API:
           else
               ... do something with error ...
         """
-        response = self._request("GET", path)
-        return self._handle_response(response)
+        (result, entry, headers) = self._lookup(path)
+        if result:
+            return result
+
+        response = self._request("GET", path, extra_headers=headers)
+        return self._handle_get_response(path, entry, response)
+
+    def iter_items(self, path, key=None):
+        """
+        Iterates over the items of a collection in the Speakap API, following its pagination.
+
+        @param path The path of the REST endpoint of the collection, including optional query
+                    parameters.
+        @param key The key of the items in the _embedded object of every page. May be omitted if
+                   the pages contain only a single embedded list.
+
+        @return A generator yielding the items one at a time. See iter_pages() for details.
+
+        Example:
+
+          for user in speakap_api.iter_items("/networks/%s/users/" % network_eid, "users"):
+              ... do something with user ...
+        """
+        for page in self.iter_pages(path):
+            if isinstance(page, list):
+                items = page
+            else:
+                embedded = page.get("_embedded", {})
+                if key:
+                    items = embedded.get(key, [])
+                else:
+                    lists = [value for value in embedded.values() if isinstance(value, list)]
+                    if len(lists) > 1:
+                        raise ValueError("Page contains multiple embedded lists, specify a key")
+                    items = lists[0] if lists else []
+
+            for item in items:
+                yield item
+
+    def iter_pages(self, path):
+        """
+        Iterates over the pages of a collection in the Speakap API.
+
+        @param path The path of the REST endpoint of the collection, including optional query
+                    parameters.
+
+        @return A generator yielding the parsed JSON reply of every page.
+
+        The next page is determined by the next link (_links.next.href) of every page, and is
+        requested in the background while the current page is being processed. Only the current
+        and the next page are held in memory, regardless of the size of the collection.
+
+        Raises an APIError, containing the error object, if a request fails.
+        """
+        response = self._start_request("GET", path)
+        while response:
+            (json_result, error) = self._handle_response(response())
+            if error:
+                raise APIError(error)
+
+            next_path = self._next_page_path(json_result)
+            response = self._start_request("GET", next_path) if next_path else None
+            yield json_result
 
     def post(self, path, data):
         """
@@ -167,6 +686,7 @@ class API:
           else
               ... do something with error ...
         """
+        self._invalidate(path)
         response = self._request("POST", path, json.dumps(data))
         return self._handle_response(response)
 
@@ -188,7 +708,8 @@ class API:
           else
               ... do something with error ...
         """
-        response = self._request("POST", path, urllib.urlencode(data) if data else None)
+        self._invalidate(path)
+        response = self._request("POST", path, urlencode(data) if data else None)
         return self._handle_response(response)
 
     def put(self, path, data):
@@ -209,7 +730,8 @@ class API:
           else
               ... do something with error ...
         """
-        response = self._create_connection("PUT", path, json.dumps(data))
+        self._invalidate(path)
+        response = self._request("PUT", path, json.dumps(data))
         return self._handle_response(response)
 
     def validate_signature(self, params):
@@ -221,51 +743,191 @@ class API:
         Raises a SignatureValidationError if the signature doesn't match or the signed request is
         expired.
         """
-        if "signature" not in params:
-            raise SignatureValidationError("Parameters did not include a signature")
+        self.signature_validator.validate(params)
 
-        signature = params["signature"]
+    def validate_signatures(self, params_list):
+        """
+        Validates the signatures of multiple signed requests, for example when processing queued
+        requests offline.
 
-        keys = params.keys()
-        keys.sort()
-        query_string = "&".join(quote(key, "~") + "=" + quote(params[key], "~") \
-                       for key in keys if key != "signature")
-        computed_hash = base64.b64encode(hmac.new(self.app_secret, query_string, hashlib.sha256)
-                                             .digest())
+        @param params_list List of objects containing the parameters of signed requests.
 
-        if computed_hash != signature:
-            raise SignatureValidationError("Invalid signature: " + query_string)
+        @return List containing None for every valid signed request, and the
+                SignatureValidationError for every invalid one, in the same order as the
+                signed requests.
+        """
+        return self.signature_validator.validate_many(params_list)
+
+    def _fetch_many(self, requests, max_concurrency):
+        responses = [None] * len(requests)
+        pending = deque()
+
+        def wait_for_oldest():
+            (index, rpc) = pending.popleft()
+            try:
+                result = rpc.get_result()
+                responses[index] = (result.status_code, result.content, result.headers)
+            except urlfetch.Error, exception:
+                responses[index] = _failed_response(exception)
+
+        for (index, (method, path, data, extra_headers)) in enumerate(requests):
+            if len(pending) >= max_concurrency:
+                wait_for_oldest()
+            rpc = urlfetch.create_rpc()
+            urlfetch.make_fetch_call(rpc, self.scheme + "://" + self.hostname + path,
+                                     headers=self._headers(extra_headers),
+                                     method=method,
+                                     payload=data,
+                                     validate_certificate=True)
+            pending.append((index, rpc))
+        while pending:
+            wait_for_oldest()
+
+        return responses
+
+    def _request_many(self, requests, max_concurrency):
+        responses = [None] * len(requests)
+        indices = Queue.Queue()
+        for index in range(len(requests)):
+            indices.put(index)
+
+        def worker():
+            while True:
+                try:
+                    index = indices.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    responses[index] = self._request(*requests[index])
+                except Exception, exception:
+                    responses[index] = _failed_response(exception)
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(min(max_concurrency, len(requests)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return responses
+
+    def _headers(self, extra_headers=None):
+        headers = {"Authorization": "Bearer " + self.access_token}
+        if extra_headers:
+            headers.update(extra_headers)
+        return headers
 
-        issued_at = iso8601.parse_date(params["issuedAt"])
-        expires_at = issued_at + timedelta(minutes=SIGNATURE_WINDOW_SIZE)
-        if datetime.utcnow() > expires_at.replace(tzinfo=None):
-            raise SignatureValidationError("Expired signature")
+    def _invalidate(self, path):
+        if self.response_cache:
+            self.response_cache.invalidate(path)
 
-    def _request(self, method, path, data=None):
-        headers = {"Authorization": "Bearer " + self.access_token}
+    def _lookup(self, path):
+        """
+        Looks up the cached reply to a GET request.
+
+        @return A tuple containing the result to return if a fresh reply is cached, the cache
+                entry if the path is cacheable, and the headers to send with the request.
+        """
+        if not self.response_cache or self.response_cache.ttl_for(path) is None:
+            return (None, None, None)
+
+        entry = self.response_cache.lookup(path)
+        if entry is None:
+            return (None, None, None)
+        if entry["expires_at"] > time.time():
+            return ((entry["result"], None), entry, None)
+        if entry["etag"]:
+            return (None, entry, {"If-None-Match": entry["etag"]})
+        return (None, entry, None)
+
+    def _next_page_path(self, json_result):
+        try:
+            href = json_result["_links"]["next"]["href"]
+        except (KeyError, TypeError):
+            return None
+
+        base_url = self.scheme + "://" + self.hostname
+        if href.startswith(base_url):
+            href = href[len(base_url):]
+        return href or None
+
+    def _start_request(self, method, path, data=None):
+        """
+        Starts a request in the background.
+
+        @return A function that waits for the request to complete and returns its response.
+        """
         if urlfetch:
-            response = urlfetch.fetch(self.scheme + "://" + self.hostname + path,
-                                      headers=headers,
-                                      method=method,
-                                      payload=data,
-                                      validate_certificate=True)
-            status = response.status_code
-            data = response.content
+            rpc = urlfetch.create_rpc()
+            urlfetch.make_fetch_call(rpc, self.scheme + "://" + self.hostname + path,
+                                     headers=self._headers(),
+                                     method=method,
+                                     payload=data,
+                                     validate_certificate=True)
+
+            def result():
+                try:
+                    response = rpc.get_result()
+                    return (response.status_code, response.content, response.headers)
+                except urlfetch.Error, exception:
+                    return _failed_response(exception)
         else:
-            if self.scheme == "https":
-                connection = httplib.HTTPSConnection(self.hostname)
-            else:
-                connection = httplib.HTTPConnection(self.hostname)
-            connection.request(method, path, data, headers)
-            response = connection.getresponse()
-            status = response.status
-            data = response.read()
-            connection.close()
+            responses = []
+
+            def run():
+                try:
+                    responses.append(self._request(method, path, data))
+                except Exception, exception:
+                    responses.append(_failed_response(exception))
+
+            thread = threading.Thread(target=run)
+            thread.start()
 
-        return (status, data)
+            def result():
+                thread.join()
+                return responses[0]
+
+        return result
+
+    def _request(self, method, path, data=None, extra_headers=None):
+        headers = self._headers(extra_headers)
+        start = time.time()
+        status = None
+        try:
+            if urlfetch:
+                response = urlfetch.fetch(self.scheme + "://" + self.hostname + path,
+                                          headers=headers,
+                                          method=method,
+                                          payload=data,
+                                          validate_certificate=True)
+                status = response.status_code
+                return (response.status_code, response.content, response.headers)
+            else:
+                response = self.connection_pool.request(self.scheme, self.hostname,
+                                                        method, path, data, headers)
+                status = response[0]
+                return response
+        finally:
+            if self.request_hook:
+                self.request_hook(method, path, status, time.time() - start)
+
+    def _handle_get_response(self, path, entry, response):
+        cache = self.response_cache
+        if not cache or cache.ttl_for(path) is None:
+            return self._handle_response(response)
+
+        (status, data, headers) = response
+        if status == 304 and entry:
+            cache.revalidated(path, entry)
+            return (entry["result"], None)
+
+        (json_result, error) = self._handle_response(response)
+        if error is None:
+            cache.store(path, json_result, headers.get("etag") or headers.get("ETag"))
+        return (json_result, error)
 
     def _handle_response(self, response):
-        (status, data) = response
+        (status, data) = response[:2]
 
         try:
             json_result = json.loads(data)
@@ -277,3 +939,7 @@ class API:
             return (json_result, None)
         else:
             return (None, { "code": json_result["code"], "message": json_result["message"] })
+
+
+def _failed_response(exception):
+    return (503, json.dumps({ "code": -1002, "message": "Request Failed: %s" % exception }), {})
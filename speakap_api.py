@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import speakap
+import stats
 
 
 SPEAKAP_APP_ID = "000a000000000005"
@@ -10,5 +11,9 @@ speakap_api = speakap.API({
     "scheme": "https",
     "hostname": "api.speakap.io",
     "app_id": SPEAKAP_APP_ID,
-    "app_secret": SPEAKAP_APP_SECRET
+    "app_secret": SPEAKAP_APP_SECRET,
+    "request_hook": lambda method, path, status, duration: stats.record("speakap_api", duration),
+    "response_cache": speakap.ResponseCache([
+        (r"/networks/[^/]+/user/[^/]+/$", 300)
+    ])
 })
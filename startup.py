@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+"""
+Instrumentation of the startup of an instance, and deferred imports.
+
+Every stage of the startup, such as importing a module or building the Jinja environment, can
+be timed using timed(). Modules that aren't needed by every request can be imported using
+lazy_import(), which defers the actual import until the module is first used.
+
+The report of all stages is logged once the first request is handled, so the cold start latency
+can be tracked across releases. This module should be imported before any other module, as its
+import marks the start of the instance.
+"""
+
+import importlib
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+STARTED_AT = time.time()
+
+_stages = [] # list of (stage, seconds)
+_lazy_modules = []
+_lock = threading.Lock()
+_reported = False
+
+
+class LazyModule(object):
+    """Module that is imported when one of its attributes is first accessed."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        """Imports the module, if it hasn't been imported yet, and returns it."""
+        if self._module is None:
+            with timed("import " + self._name):
+                self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+
+def lazy_import(name):
+    """Returns a LazyModule for the module with the given name."""
+    module = LazyModule(name)
+    with _lock:
+        _lazy_modules.append(module)
+    return module
+
+def load_all():
+    """Imports all modules that have been lazily imported."""
+    for module in list(_lazy_modules):
+        module.load()
+
+@contextmanager
+def timed(stage):
+    """Context manager recording the time spent in a stage of the startup."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        with _lock:
+            _stages.append((stage, time.time() - start))
+
+def report():
+    """
+    Returns a report of the startup of the instance.
+
+    @return Dictionary with the time the instance started, the time since then and the time
+            spent in every stage of the startup, in the order the stages finished.
+    """
+    with _lock:
+        stages = list(_stages)
+    return {
+        "started_at": STARTED_AT,
+        "uptime": time.time() - STARTED_AT,
+        "stages": [{ "stage": stage, "ms": round(seconds * 1000, 1) } for (stage, seconds) in stages],
+        "total_ms": round(sum(seconds for (stage, seconds) in stages) * 1000, 1)
+    }
+
+def request_started():
+    """Logs the startup report when the first request of the instance is handled."""
+    global _reported
+    if _reported:
+        return
+    with _lock:
+        if _reported:
+            return
+        _reported = True
+
+    startup_report = report()
+    logging.info("Instance startup took %.1fms: %s", startup_report["total_ms"],
+                 ", ".join("%s %.1fms" % (stage["stage"], stage["ms"])
+                           for stage in startup_report["stages"]))
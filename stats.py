@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-process latency statistics of the stages of handling a request.
+
+Every stage, such as validating a signature, loading the ranking or rendering the template, is
+timed using timed() and recorded in a histogram with fixed, exponentially growing buckets. This
+makes recording a timing a matter of a bisect and two increments, so the instrumentation can be
+left enabled in production. Percentiles are estimated from the buckets, and are accurate to
+within BUCKET_GROWTH.
+
+StatsMiddleware times complete requests, and logs the breakdown of every request that takes
+longer than SLOW_REQUEST_THRESHOLD per stage. install_rpc_hooks() times every App Engine API call,
+such as datastore and memcache calls, as a stage named after the service and method.
+
+Statistics are kept per instance and are reset when the instance is shut down.
+"""
+
+import bisect
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+SLOW_REQUEST_THRESHOLD = 1.0 # seconds
+
+BUCKET_GROWTH = 1.25
+
+# upper bounds of the buckets in seconds, from 0.1ms to about 70s
+BUCKETS = [0.0001 * BUCKET_GROWTH ** index for index in range(61)]
+
+PERCENTILES = (50, 95, 99)
+
+
+class Histogram:
+    """Histogram of durations."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percentile):
+        """Returns the upper bound of the bucket containing the given percentile, in seconds."""
+        threshold = self.count * percentile / 100.0
+        cumulative = 0
+        for (index, count) in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= threshold and cumulative > 0:
+                return BUCKETS[index] if index < len(BUCKETS) else self.max
+        return 0.0
+
+    def summary(self):
+        summary = {
+            "count": self.count,
+            "mean_ms": round(self.total * 1000 / self.count, 2) if self.count else 0,
+            "max_ms": round(self.max * 1000, 2)
+        }
+        for percentile in PERCENTILES:
+            summary["p%d_ms" % percentile] = round(self.percentile(percentile) * 1000, 2)
+        return summary
+
+
+_histograms = {}
+_lock = threading.Lock()
+_request = threading.local()
+_started_at = time.time()
+
+
+def record(stage, seconds):
+    """Records the duration of a stage."""
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = Histogram()
+        histogram.add(seconds)
+
+    stages = getattr(_request, "stages", None)
+    if stages is not None:
+        stages.append((stage, seconds))
+
+@contextmanager
+def timed(stage):
+    """Context manager recording the time spent in a stage."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(stage, time.time() - start)
+
+def snapshot():
+    """
+    Returns the statistics of all stages.
+
+    @return Dictionary with the time statistics were started to be collected and, for every
+            stage, the number of times it was recorded and its mean, maximum and percentile
+            durations in milliseconds.
+    """
+    with _lock:
+        stages = dict((stage, histogram.summary()) for (stage, histogram) in _histograms.items())
+    return { "since": _started_at, "stages": stages }
+
+def reset():
+    """Discards all statistics."""
+    global _started_at
+    with _lock:
+        _histograms.clear()
+        _started_at = time.time()
+
+def install_rpc_hooks():
+    """
+    Times every App Engine API call, as a stage named "rpc.<service>.<method>".
+
+    Does nothing when not running on Google App Engine.
+    """
+    try:
+        from google.appengine.api import apiproxy_stub_map
+    except ImportError:
+        return
+
+    calls = {}
+
+    def pre_call(service, call, request, response, rpc):
+        calls[id(rpc)] = time.time()
+
+    def post_call(service, call, request, response, rpc, error):
+        start = calls.pop(id(rpc), None)
+        if start is not None:
+            record("rpc.%s.%s" % (service, call), time.time() - start)
+
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append("stats", pre_call)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append("stats", post_call)
+
+
+class StatsMiddleware:
+    """
+    WSGI middleware timing complete requests, as the "request" stage.
+
+    Requests taking longer than SLOW_REQUEST_THRESHOLD are logged with the duration of every
+    stage recorded while handling them.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        _request.stages = []
+        start = time.time()
+        result = None
+        try:
+            result = self.app(environ, start_response)
+            for chunk in result:
+                yield chunk
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+            duration = time.time() - start
+            stages = _request.stages
+            _request.stages = None
+            record("request", duration)
+
+            if duration > SLOW_REQUEST_THRESHOLD:
+                logging.warning("Slow request %s %s took %.1fms: %s",
+                                environ.get("REQUEST_METHOD"), environ.get("PATH_INFO"),
+                                duration * 1000,
+                                ", ".join("%s %.1fms" % (stage, seconds * 1000)
+                                          for (stage, seconds) in stages))
@@ -0,0 +1,734 @@
+# -*- coding: utf-8 -*-
+
+"""
+Storage backends for products and votes.
+
+The request handlers only use the Storage interface, so the app can run on Google App Engine
+using DatastoreStorage, as well as under any multi-process WSGI server using SQLiteStorage, or
+on a single process using MemoryStorage (for example for load tests).
+
+Products are identified by their normalized name (see normalize_name()), and every backend ranks
+them the same way: by number of voters, then by name. Rankings are returned in pages of entries,
+each being a dictionary with key, name, num_voters and voters properties, where voters contains
+at most PREVIEW_SIZE EIDs. Pages are identified by opaque, URL-safe cursors.
+
+Every Speakap network that installs the app has its own products, votes and ranking. All methods
+take the EID of the network, and backends keep the data of every network apart, so that the
+ranking of a network only involves that network's data and one network can't see another's
+products.
+"""
+
+import base64
+import calendar
+import heapq
+import json
+import math
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+
+try:
+    import counters
+    import leaderboard
+    import models
+
+    from google.appengine.api import namespace_manager
+    from google.appengine.ext import db
+except ImportError:
+    # not running on Google App Engine
+    counters = None
+    leaderboard = None
+    models = None
+    namespace_manager = None
+    db = None
+
+
+# the same as leaderboard.SIZE and counters.PREVIEW_SIZE, which can't be imported off App Engine
+PAGE_SIZE = 20
+
+PREVIEW_SIZE = 10
+
+# the weight of a vote in the trending ranking halves every TRENDING_HALF_LIFE seconds
+TRENDING_HALF_LIFE = 24 * 60 * 60
+
+TRENDING_EPOCH = calendar.timegm((2014, 1, 1, 0, 0, 0))
+
+# the maximum length of a normalized product name, which keeps the key names of the products and
+# their votes and shards well within the datastore's limits
+MAX_NAME_LENGTH = 100
+
+# the longest prefix of a word that is indexed for autocompletion, see autocomplete.py
+MAX_PREFIX_LENGTH = 20
+
+
+class InvalidCursorError(ValueError):
+    """Exception thrown when a cursor passed to Storage.get_ranking() is invalid."""
+    pass
+
+
+def normalize_name(name):
+    """
+    Normalizes the name of a product, so names differing only in case or whitespace map to the
+    same product. Names are truncated to MAX_NAME_LENGTH characters.
+
+    @return The normalized name, or None if the name is empty after normalization.
+    """
+    return " ".join(name.split()).lower()[:MAX_NAME_LENGTH].rstrip() or None
+
+def word_starts(key):
+    """
+    Returns the parts of a normalized name that start at a word, from the whole name to its
+    last word, so "blue pen" yields "blue pen" and "pen".
+    """
+    starts = [0] + [index + 1 for (index, char) in enumerate(key) if char == " "]
+    return [key[start:] for start in starts]
+
+def prefix_tokens(name):
+    """
+    Returns the prefixes of at most MAX_PREFIX_LENGTH characters of every word start of a name,
+    see word_starts(), for looking up products by the prefix of any of their words.
+    """
+    tokens = set()
+    for word in word_starts(normalize_name(name) or ""):
+        for length in range(1, min(len(word), MAX_PREFIX_LENGTH) + 1):
+            tokens.add(word[:length])
+    return sorted(tokens)
+
+def trending_weight(timestamp):
+    """
+    Returns the logarithm of the weight of a vote cast at the given UNIX timestamp, relative to
+    TRENDING_EPOCH.
+
+    Trending scores are kept as the logarithm of the sum of these weights. As the weights of all
+    votes decay at the same rate, scores never need to be decayed to compare them.
+    """
+    return math.log(2) * (timestamp - TRENDING_EPOCH) / TRENDING_HALF_LIFE
+
+def add_weights(log_score, log_weight):
+    """Adds the weight of a vote to a trending score, both given as logarithms."""
+    if log_score is None:
+        return log_weight
+    (high, low) = (max(log_score, log_weight), min(log_score, log_weight))
+    return high + math.log1p(math.exp(low - high))
+
+def trending_score(log_score, now=None):
+    """Returns the trending score at the given time (default now), in number of fresh votes."""
+    return math.exp(log_score - trending_weight(now or time.time()))
+
+def _decode_cursor(cursor):
+    try:
+        (num_voters, name) = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        return (int(num_voters), unicode(name))
+    except (TypeError, ValueError):
+        raise InvalidCursorError("Invalid cursor: %s" % cursor)
+
+def _encode_cursor(entries):
+    # the cursor is the position of the last entry of the page, so pages never skip or repeat
+    # products while votes are cast, except for products that move across the page boundary
+    if len(entries) < PAGE_SIZE:
+        return None
+    last = entries[-1]
+    return base64.urlsafe_b64encode(json.dumps([last["num_voters"], last["name"]]))
+
+def _rank(entry):
+    return (-entry["num_voters"], entry["name"])
+
+
+class Storage:
+    """Interface of the storage backends."""
+
+    def get_product(self, network_eid, name):
+        """
+        Returns the entry of the product with the given name, or None if it doesn't exist.
+        """
+        raise NotImplementedError
+
+    def create_product(self, network_eid, name):
+        """
+        Returns the entry of the product with the given name, creating the product if needed.
+
+        Returns None if the name is empty.
+        """
+        raise NotImplementedError
+
+    def cast_vote(self, network_eid, product_name, user_eid):
+        """
+        Registers a vote of a user on a product, creating the product if needed.
+
+        @param network_eid EID of the network of the user.
+        @param product_name Name of the product, as entered by the user.
+        @param user_eid EID of the user casting the vote.
+
+        @return True if the vote was accepted, False if the name is empty or the user had already
+                voted on the product.
+        """
+        raise NotImplementedError
+
+    def cast_votes(self, network_eid, votes):
+        """
+        Registers multiple votes, creating products if needed.
+
+        Backends write the votes in batches, so this is considerably faster than calling
+        cast_vote() for every vote.
+
+        @param network_eid EID of the network of the users.
+        @param votes List of (product name, user EID) tuples.
+
+        @return List containing True for every vote that was accepted and False for every other
+                vote, see cast_vote(), in the same order as the votes. Of duplicate votes within
+                the list, only the first is accepted.
+        """
+        raise NotImplementedError
+
+    def get_ranking(self, network_eid, cursor=None, pending_vote=None):
+        """
+        Returns a page of at most PAGE_SIZE ranked products of a network.
+
+        @param network_eid EID of the network.
+        @param cursor Cursor of the page, as returned for the previous page, or None for the
+                      first page.
+        @param pending_vote Optional (product name, user EID) tuple of a vote that was just cast.
+                            Backends that accept votes before they are counted apply it to the
+                            first page, so users always see their own vote.
+
+        @return (entries, cursor) tuple, where entries is the list of ranking entries and cursor
+                is the cursor of the next page, or None if there is none.
+
+        Raises an InvalidCursorError if the cursor is invalid.
+        """
+        raise NotImplementedError
+
+    def get_version(self, network_eid):
+        """
+        Returns the version of the rankings of a network, which changes whenever the rankings
+        change.
+
+        Versions can be compared for equality only, and are cheap to obtain, so they can be used
+        to check whether a page rendered from the rankings is still up to date.
+        """
+        raise NotImplementedError
+
+    def get_trending(self, network_eid):
+        """
+        Returns the top PAGE_SIZE trending products of a network, see trending_weight().
+
+        @param network_eid EID of the network.
+
+        @return List of ranking entries, which have an additional score property containing the
+                current trending score. The voters of the entries are the most recent voters.
+        """
+        raise NotImplementedError
+
+    def iter_products(self, network_eid, limit):
+        """
+        Iterates over the most popular products of a network, for loading an autocompletion
+        index (see autocomplete.py).
+
+        @return Iterator over at most limit entries with key, name and num_voters properties,
+                ordered by number of voters.
+        """
+        raise NotImplementedError
+
+    def find_products(self, network_eid, prefix, limit):
+        """
+        Returns the most popular products of a network with a word starting with a prefix.
+
+        @param network_eid EID of the network.
+        @param prefix Normalized prefix, see normalize_name().
+        @param limit Maximum number of products to return.
+
+        @return List of entries with key, name and num_voters properties, ordered by number of
+                voters.
+
+        Raises NotImplementedError if the backend can't look up products by prefix, in which
+        case all products are loaded using iter_products() instead.
+        """
+        raise NotImplementedError
+
+
+class DatastoreStorage(Storage):
+    """
+    Storage in the App Engine datastore, using sharded counters (see counters.py) and the
+    materialized leaderboard (see leaderboard.py).
+
+    Every network is kept in its own namespace, named after the EID of the network. This
+    partitions the entities, the indexes used by the ranking queries and the memcache keys of
+    the leaderboard, without any of the modules involved having to be aware of networks.
+
+    If write_behind is True, votes are buffered in a pull queue and written in batches (see
+    votebuffer.py). If index_prefixes is True, products store the prefixes of the words of their
+    name, so find_products() can query them. As every prefix is an index row, this multiplies the
+    cost of creating a product, so otherwise find_products() isn't supported and autocompletion
+    relies on the index loaded by iter_products().
+    """
+    def __init__(self, write_behind=False, index_prefixes=False):
+        self.write_behind = write_behind
+        self.index_prefixes = index_prefixes
+
+    def get_product(self, network_eid, name):
+        key_name = models.Product.key_name_for(name)
+        if not key_name:
+            return None
+        with self._namespace(network_eid):
+            product = models.Product.get_by_key_name(key_name)
+            if product is None:
+                return None
+            counters.load_counts([product])
+        return self._entry(product)
+
+    def create_product(self, network_eid, name):
+        key_name = models.Product.key_name_for(name)
+        if not key_name:
+            return None
+        with self._namespace(network_eid):
+            product = models.Product.get_or_insert_by_name(name, self.index_prefixes)
+            counters.load_counts([product])
+        return self._entry(product)
+
+    def cast_vote(self, network_eid, product_name, user_eid):
+        with self._namespace(network_eid):
+            if self.write_behind:
+                # imported here, as the task queue API isn't needed otherwise
+                import votebuffer
+                return votebuffer.add(product_name, user_eid)
+
+            key_name = models.Product.key_name_for(product_name)
+            if not key_name:
+                return False
+            # a get by key, as a transaction is only needed to create the product
+            product = models.Product.get_by_key_name(key_name) or \
+                models.Product.get_or_insert_by_name(product_name, self.index_prefixes)
+            if not counters.cast_vote(product, user_eid):
+                return False
+            leaderboard.record_vote(product, user_eid)
+            # imported here, as requests that only display the ranking don't need it
+            import trending
+            trending.record_votes(product, [user_eid])
+        return True
+
+    def cast_votes(self, network_eid, votes):
+        with self._namespace(network_eid):
+            if self.write_behind:
+                import votebuffer
+                return votebuffer.add_batch(votes)
+
+            names = {} # key name -> product name
+            user_eids = {} # key name -> list of user EIDs
+            for (product_name, user_eid) in votes:
+                key_name = models.Product.key_name_for(product_name)
+                if key_name:
+                    names.setdefault(key_name, product_name.strip()[:MAX_NAME_LENGTH])
+                    user_eids.setdefault(key_name, []).append(user_eid)
+
+            key_names = names.keys()
+            # the products and votes are written in batches of cross-group transactions, so the
+            # number of commits depends on the number of votes rather than the number of products
+            products = models.Product.get_or_insert_by_names(
+                [names[key_name] for key_name in key_names], self.index_prefixes)
+
+            batch = zip(products, [user_eids[key_name] for key_name in key_names])
+            counted = [(product, eids) for ((product, voters), eids)
+                       in zip(batch, counters.cast_batch(batch)) if eids]
+            if counted:
+                leaderboard.record_batch(counted)
+                import trending
+                trending.record_batch(counted)
+
+        accepted = set((product.key().name(), user_eid)
+                       for (product, eids) in counted for user_eid in eids)
+        result = []
+        for (product_name, user_eid) in votes:
+            vote = (models.Product.key_name_for(product_name), user_eid)
+            result.append(vote in accepted)
+            accepted.discard(vote)
+        return result
+
+    def get_ranking(self, network_eid, cursor=None, pending_vote=None):
+        with self._namespace(network_eid):
+            if cursor:
+                try:
+                    return leaderboard.get_page(cursor)
+                except ValueError, exception:
+                    raise InvalidCursorError(str(exception))
+
+            (entries, next_cursor) = leaderboard.get_top_page()
+            if self.write_behind and pending_vote:
+                import votebuffer
+                votebuffer.apply_pending(entries, *pending_vote)
+        return (entries, next_cursor)
+
+    def get_version(self, network_eid):
+        with self._namespace(network_eid):
+            return leaderboard.get_version()
+
+    def get_trending(self, network_eid):
+        # the trending ranking is aggregated by a cron job, see trending.py
+        with self._namespace(network_eid):
+            import trending
+            return trending.get_top()
+
+    def iter_products(self, network_eid, limit):
+        with self._namespace(network_eid):
+            query = db.Query(models.Product, projection=("name", "num_voters"))
+            products = list(query.order("-num_voters").run(limit=limit, batch_size=1000))
+        for product in products:
+            yield self._entry(product, preview=False)
+
+    def find_products(self, network_eid, prefix, limit):
+        # products are indexed by the prefixes of their words (see models.Product); products
+        # created before the prefixes were stored are only found by the loaded index
+        if not self.index_prefixes:
+            raise NotImplementedError("Prefixes of product names aren't indexed")
+        with self._namespace(network_eid):
+            query = db.Query(models.Product, projection=("name", "num_voters"))
+            query.filter("name_prefixes =", prefix[:MAX_PREFIX_LENGTH]).order("-num_voters")
+            products = query.fetch(limit)
+        entries = [self._entry(product, preview=False) for product in products]
+        if len(prefix) > MAX_PREFIX_LENGTH:
+            entries = [entry for entry in entries if any(
+                word.startswith(prefix) for word in word_starts(normalize_name(entry["name"])))]
+        return entries
+
+    @contextmanager
+    def _namespace(self, network_eid):
+        previous = namespace_manager.get_namespace()
+        namespace_manager.set_namespace(network_eid or "")
+        try:
+            yield
+        finally:
+            namespace_manager.set_namespace(previous)
+
+    def _entry(self, product, preview=True):
+        entry = {
+            "key": str(product.key()),
+            "name": product.name,
+            "num_voters": product.num_voters
+        }
+        if preview:
+            entry["voters"] = product.voters
+        return entry
+
+
+class SQLiteStorage(Storage):
+    """
+    Storage in a SQLite database, which can be shared by multiple processes on the same host.
+
+    The database runs in WAL mode, so the ranking can be read while votes are written. Products
+    are ranked using an index on the network and num_voters, and the preview of voters using an
+    index on the time of voting, so neither query scans all votes or the products of other
+    networks. Pages of the ranking start from the position in the index encoded in the cursor,
+    rather than skipping the preceding products. Every thread uses its own connection, which
+    keeps its statements prepared.
+
+    Trending scores are updated along with every vote, and ranked using an index as well.
+    """
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS products ("
+        "  network TEXT NOT NULL,"
+        "  key TEXT NOT NULL,"
+        "  name TEXT NOT NULL,"
+        "  num_voters INTEGER NOT NULL DEFAULT 0,"
+        "  PRIMARY KEY (network, key))",
+        "CREATE INDEX IF NOT EXISTS products_ranking ON products (network, num_voters DESC, name)",
+        "CREATE TABLE IF NOT EXISTS votes ("
+        "  network TEXT NOT NULL,"
+        "  product_key TEXT NOT NULL,"
+        "  user_eid TEXT NOT NULL,"
+        "  created REAL NOT NULL,"
+        "  PRIMARY KEY (network, product_key, user_eid))",
+        "CREATE INDEX IF NOT EXISTS votes_preview ON votes (network, product_key, created)",
+        "CREATE TABLE IF NOT EXISTS trending ("
+        "  network TEXT NOT NULL,"
+        "  key TEXT NOT NULL,"
+        "  log_score REAL NOT NULL,"
+        "  PRIMARY KEY (network, key))",
+        "CREATE INDEX IF NOT EXISTS trending_ranking ON trending (network, log_score DESC)",
+        "CREATE TABLE IF NOT EXISTS versions ("
+        "  network TEXT PRIMARY KEY,"
+        "  version INTEGER NOT NULL)"
+    ]
+
+    def __init__(self, path, timeout=10):
+        """
+        @param path Path of the database file, which is created if it doesn't exist.
+        @param timeout Number of seconds to wait for a lock on the database.
+        """
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        for statement in self.SCHEMA:
+            connection.execute(statement)
+
+    def get_product(self, network_eid, name):
+        key = normalize_name(name)
+        if not key:
+            return None
+        row = self._connection().execute(
+            "SELECT network, key, name, num_voters FROM products WHERE network = ? AND key = ?",
+            (network_eid, key)).fetchone()
+        return self._entry(row) if row else None
+
+    def create_product(self, network_eid, name):
+        key = normalize_name(name)
+        if not key:
+            return None
+        connection = self._connection()
+        connection.execute("INSERT OR IGNORE INTO products (network, key, name) VALUES (?, ?, ?)",
+                           (network_eid, key, name.strip()[:MAX_NAME_LENGTH]))
+        return self.get_product(network_eid, name)
+
+    def cast_vote(self, network_eid, product_name, user_eid):
+        return self.cast_votes(network_eid, [(product_name, user_eid)])[0]
+
+    def cast_votes(self, network_eid, votes):
+        connection = self._connection()
+        # the write lock is taken upfront, so concurrent votes wait instead of failing when they
+        # would upgrade a read lock. all votes are written in a single transaction
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            result = [self._cast_vote(connection, network_eid, product_name, user_eid, now)
+                      for (product_name, user_eid) in votes]
+            if any(result):
+                # versions start at the current time in milliseconds, so they aren't reused if
+                # the database is recreated
+                connection.execute("INSERT OR IGNORE INTO versions (network, version) "
+                                   "VALUES (?, ?)", (network_eid, int(now * 1000)))
+                connection.execute("UPDATE versions SET version = version + 1 "
+                                   "WHERE network = ?", (network_eid,))
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        return result
+
+    def get_ranking(self, network_eid, cursor=None, pending_vote=None):
+        if cursor:
+            (num_voters, name) = _decode_cursor(cursor)
+            rows = self._connection().execute(
+                "SELECT network, key, name, num_voters FROM products "
+                "WHERE network = ? AND num_voters <= ? AND (num_voters < ? OR name > ?) "
+                "ORDER BY num_voters DESC, name LIMIT ?",
+                (network_eid, num_voters, num_voters, name, PAGE_SIZE)).fetchall()
+        else:
+            rows = self._connection().execute(
+                "SELECT network, key, name, num_voters FROM products WHERE network = ? "
+                "ORDER BY num_voters DESC, name LIMIT ?", (network_eid, PAGE_SIZE)).fetchall()
+
+        entries = [self._entry(row) for row in rows]
+        return (entries, _encode_cursor(entries))
+
+    def get_version(self, network_eid):
+        row = self._connection().execute("SELECT version FROM versions WHERE network = ?",
+                                         (network_eid,)).fetchone()
+        return row[0] if row else 0
+
+    def get_trending(self, network_eid):
+        rows = self._connection().execute(
+            "SELECT products.network, products.key, products.name, products.num_voters, "
+            "  trending.log_score FROM trending JOIN products "
+            "  ON products.network = trending.network AND products.key = trending.key "
+            "WHERE trending.network = ? ORDER BY trending.log_score DESC LIMIT ?",
+            (network_eid, PAGE_SIZE)).fetchall()
+
+        now = time.time()
+        entries = []
+        for row in rows:
+            entry = self._entry(row[:4], recent=True)
+            entry["score"] = trending_score(row[4], now)
+            entries.append(entry)
+        return entries
+
+    def iter_products(self, network_eid, limit):
+        rows = self._connection().execute(
+            "SELECT key, name, num_voters FROM products WHERE network = ? "
+            "ORDER BY num_voters DESC, name LIMIT ?", (network_eid, limit))
+        for (key, name, num_voters) in rows:
+            yield { "key": key, "name": name, "num_voters": num_voters }
+
+    def find_products(self, network_eid, prefix, limit):
+        # names starting with the prefix are found using the primary key, while names with a
+        # later word starting with it take a scan of the products of the network
+        rows = self._connection().execute(
+            "SELECT key, name, num_voters FROM products "
+            "WHERE network = ? AND ((key >= ? AND key < ?) OR instr(key, ?) > 0) "
+            "ORDER BY num_voters DESC, name LIMIT ?",
+            (network_eid, prefix, prefix + u"\uffff", " " + prefix, limit)).fetchall()
+        return [{ "key": key, "name": name, "num_voters": num_voters }
+                for (key, name, num_voters) in rows]
+
+    def _cast_vote(self, connection, network_eid, product_name, user_eid, now):
+        key = normalize_name(product_name)
+        if not key:
+            return False
+
+        connection.execute("INSERT OR IGNORE INTO products (network, key, name) VALUES (?, ?, ?)",
+                           (network_eid, key, product_name.strip()[:MAX_NAME_LENGTH]))
+        cursor = connection.execute(
+            "INSERT OR IGNORE INTO votes (network, product_key, user_eid, created) "
+            "VALUES (?, ?, ?, ?)", (network_eid, key, user_eid, now))
+        if cursor.rowcount != 1:
+            return False
+
+        connection.execute("UPDATE products SET num_voters = num_voters + 1 "
+                           "WHERE network = ? AND key = ?", (network_eid, key))
+        row = connection.execute("SELECT log_score FROM trending WHERE network = ? AND key = ?",
+                                 (network_eid, key)).fetchone()
+        log_score = add_weights(row[0] if row else None, trending_weight(now))
+        connection.execute("INSERT OR REPLACE INTO trending (network, key, log_score) "
+                           "VALUES (?, ?, ?)", (network_eid, key, log_score))
+        return True
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # autocommit mode, transactions are started explicitly
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            self._local.connection = connection
+        return connection
+
+    def _entry(self, row, recent=False):
+        (network_eid, key, name, num_voters) = row
+        voters = self._connection().execute(
+            "SELECT user_eid FROM votes WHERE network = ? AND product_key = ? "
+            "ORDER BY created %s LIMIT ?" % ("DESC" if recent else "ASC"),
+            (network_eid, key, PREVIEW_SIZE)).fetchall()
+        return {
+            "key": key,
+            "name": name,
+            "num_voters": num_voters,
+            "voters": [voter for (voter,) in voters]
+        }
+
+
+class MemoryStorage(Storage):
+    """
+    Storage in memory, which is lost when the process exits.
+
+    Only suitable for a single process, such as a development server or a load test. Instances
+    are safe to use from multiple threads.
+    """
+    def __init__(self):
+        self._networks = {} # network EID -> key -> (entry, set of voters)
+        self._trending = {} # network EID -> key -> (log score, most recent voters)
+        self._versions = {} # network EID -> version
+        # versions start at the time the storage is created, so they aren't reused after a restart
+        self._initial_version = int(time.time() * 1000)
+        self._lock = threading.Lock()
+
+    def get_product(self, network_eid, name):
+        key = normalize_name(name)
+        with self._lock:
+            product = self._networks.get(network_eid, {}).get(key) if key else None
+            return self._copy(product[0]) if product else None
+
+    def create_product(self, network_eid, name):
+        key = normalize_name(name)
+        if not key:
+            return None
+        with self._lock:
+            return self._copy(self._get_or_create(network_eid, key, name)[0])
+
+    def cast_vote(self, network_eid, product_name, user_eid):
+        return self.cast_votes(network_eid, [(product_name, user_eid)])[0]
+
+    def cast_votes(self, network_eid, votes):
+        now = time.time()
+        with self._lock:
+            result = [self._cast_vote(network_eid, product_name, user_eid, now)
+                      for (product_name, user_eid) in votes]
+            if any(result):
+                self._versions[network_eid] = \
+                    self._versions.get(network_eid, self._initial_version) + 1
+        return result
+
+    def get_ranking(self, network_eid, cursor=None, pending_vote=None):
+        if cursor:
+            (num_voters, name) = _decode_cursor(cursor)
+            start = (-num_voters, name)
+        else:
+            start = None
+
+        with self._lock:
+            products = self._networks.get(network_eid, {})
+            entries = heapq.nsmallest(PAGE_SIZE, (entry for (entry, voters)
+                                                  in products.itervalues()
+                                                  if start is None or _rank(entry) > start),
+                                      key=_rank)
+            entries = [self._copy(entry) for entry in entries]
+        return (entries, _encode_cursor(entries))
+
+    def get_version(self, network_eid):
+        with self._lock:
+            return self._versions.get(network_eid, self._initial_version)
+
+    def get_trending(self, network_eid):
+        now = time.time()
+        with self._lock:
+            scores = self._trending.get(network_eid, {})
+            products = self._networks.get(network_eid, {})
+            keys = heapq.nlargest(PAGE_SIZE, scores, key=lambda key: scores[key][0])
+            entries = []
+            for key in keys:
+                (log_score, recent) = scores[key]
+                entries.append(dict(products[key][0], voters=list(recent),
+                                    score=trending_score(log_score, now)))
+        return entries
+
+    def iter_products(self, network_eid, limit):
+        with self._lock:
+            products = self._networks.get(network_eid, {})
+            entries = heapq.nsmallest(limit, (entry for (entry, voters) in products.itervalues()),
+                                      key=_rank)
+            entries = [{ "key": entry["key"], "name": entry["name"],
+                         "num_voters": entry["num_voters"] } for entry in entries]
+        return iter(entries)
+
+    def find_products(self, network_eid, prefix, limit):
+        with self._lock:
+            products = self._networks.get(network_eid, {})
+            entries = heapq.nsmallest(limit, (entry for (key, (entry, voters))
+                                              in products.iteritems()
+                                              if any(word.startswith(prefix)
+                                                     for word in word_starts(key))),
+                                      key=_rank)
+            return [{ "key": entry["key"], "name": entry["name"],
+                      "num_voters": entry["num_voters"] } for entry in entries]
+
+    def _cast_vote(self, network_eid, product_name, user_eid, now):
+        key = normalize_name(product_name)
+        if not key:
+            return False
+        (entry, voters) = self._get_or_create(network_eid, key, product_name)
+        if user_eid in voters:
+            return False
+        voters.add(user_eid)
+        entry["num_voters"] += 1
+        if len(entry["voters"]) < PREVIEW_SIZE:
+            entry["voters"].append(user_eid)
+
+        scores = self._trending.setdefault(network_eid, {})
+        (log_score, recent) = scores.get(key, (None, []))
+        scores[key] = (add_weights(log_score, trending_weight(now)),
+                       ([user_eid] + recent)[:PREVIEW_SIZE])
+        return True
+
+    def _copy(self, entry):
+        return dict(entry, voters=list(entry["voters"]))
+
+    def _get_or_create(self, network_eid, key, name):
+        products = self._networks.setdefault(network_eid, {})
+        if key not in products:
+            products[key] = ({
+                "key": key,
+                "name": name.strip()[:MAX_NAME_LENGTH],
+                "num_voters": 0,
+                "voters": []
+            }, set())
+        return products[key]
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+"""
+Time-decayed "trending" ranking of products.
+
+The trending score of a product is the sum of the weights of its votes, where the weight of a
+vote halves every storage.TRENDING_HALF_LIFE seconds. Rather than decaying every score as time
+passes, scores are kept as the logarithm of the sum of the weights relative to a fixed epoch,
+see storage.trending_weight(). As all scores decay at the same rate, this preserves their
+order, so a score only changes when a vote is added and never overflows.
+
+Every counted vote is added to the "trending" pull queue (see queue.yaml), with the time it was
+cast as an ISO 8601 date. The aggregate() function, invoked by the /tasks/aggregate-trending
+cron job, leases the new votes, parses their dates in a single batch, updates the
+TrendingScore entities of the products that were voted on and merges them into the
+TrendingSnapshot of the top-N trending products. Its cost therefore depends on the number of new
+votes only. The overview reads the snapshot with a single memcache or datastore get.
+
+Like the rest of the storage, scores and snapshots are kept in the namespace of the network the
+vote was cast in. The votes of a namespace are removed from the queue once they are aggregated,
+so a failing namespace doesn't hold up the others. Only if the aggregation of a namespace fails
+halfway may its votes be counted twice.
+"""
+
+import calendar
+import iso8601
+import json
+import leaderboard
+import logging
+import storage
+import time
+
+from datetime import datetime
+
+from google.appengine.api import memcache
+from google.appengine.api import namespace_manager
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+
+QUEUE_NAME = "trending"
+
+SIZE = 20
+
+PREVIEW_SIZE = 10
+
+LEASE_TIME = 60 # seconds
+
+MAX_TASKS = 1000 # the maximum number of tasks that can be leased at once
+
+MAX_TASKS_PER_ADD = 100 # the maximum number of tasks that can be added at once
+
+AGGREGATE_DEADLINE = 300 # seconds
+
+CACHE_KEY = "trending:v1"
+
+CACHE_TIME = 600 # seconds
+
+
+class TrendingScore(db.Model):
+    """Trending score of a product, keyed by the key name of the product."""
+    name = db.StringProperty(indexed=False)
+    log_score = db.FloatProperty(indexed=False)
+    num_votes = db.IntegerProperty(default=0, indexed=False)
+    # the most recent voters, most recent first
+    voters = db.StringListProperty(indexed=False)
+
+
+class TrendingSnapshot(db.Model):
+    entries = db.TextProperty()
+    aggregated_at = db.FloatProperty(indexed=False)
+
+
+def record_votes(product, user_eids, voted_at=None):
+    """
+    Queues counted votes for the next aggregation, in the current namespace.
+
+    @param product The Product entity that was voted on.
+    @param user_eids List of EIDs of the users whose votes were counted.
+    @param voted_at UNIX timestamp of the votes, the current time by default.
+    """
+    record_batch([(product, user_eids)], voted_at)
+
+def record_batch(votes, voted_at=None):
+    """
+    Queues counted votes on multiple products for the next aggregation, in the current namespace.
+
+    @param votes List of (product, user EIDs) tuples, see record_votes().
+    @param voted_at UNIX timestamp of the votes, the current time by default.
+
+    The tasks are added in batches of MAX_TASKS_PER_ADD.
+    """
+    voted_at = datetime.utcfromtimestamp(voted_at or time.time())
+    namespace = namespace_manager.get_namespace()
+    tasks = []
+    for (product, user_eids) in votes:
+        payload = json.dumps({
+            "namespace": namespace,
+            "key_name": product.key().name(),
+            "name": product.name,
+            "user_eids": user_eids,
+            "voted_at": voted_at.strftime("%Y-%m-%dT%H:%M:%S.%f+00:00")
+        })
+        tasks.append(taskqueue.Task(payload=payload, method="PULL"))
+
+    queue = taskqueue.Queue(QUEUE_NAME)
+    for offset in range(0, len(tasks), MAX_TASKS_PER_ADD):
+        queue.add(tasks[offset:offset + MAX_TASKS_PER_ADD])
+
+def get_top():
+    """
+    Returns the top-N trending products, in the current namespace.
+
+    @return List of entries, ordered by trending score. Every entry is a dictionary with key,
+            name, num_voters, voters and score properties, where num_voters is the number of
+            votes counted since trending scores are kept, voters contains the at most
+            PREVIEW_SIZE most recent voters and score is the current score.
+    """
+    snapshot = memcache.get(CACHE_KEY)
+    if snapshot is None:
+        entity = TrendingSnapshot.get_by_key_name("trending")
+        snapshot = json.loads(entity.entries) if entity else []
+        memcache.add(CACHE_KEY, snapshot, time=CACHE_TIME)
+
+    now = time.time()
+    for entry in snapshot:
+        entry["score"] = storage.trending_score(entry["log_score"], now)
+    return snapshot
+
+def aggregate():
+    """
+    Aggregates the votes queued since the last aggregation into the trending scores.
+
+    Keeps leasing batches of votes until the queue is drained or AGGREGATE_DEADLINE is exceeded.
+
+    @return The number of aggregated votes.
+    """
+    queue = taskqueue.Queue(QUEUE_NAME)
+    start = time.time()
+    num_aggregated = 0
+
+    while time.time() - start < AGGREGATE_DEADLINE:
+        tasks = queue.lease_tasks(LEASE_TIME, MAX_TASKS)
+        if not tasks:
+            break
+
+        payloads = [json.loads(task.payload) for task in tasks]
+        timestamps = _parse_timestamps([payload["voted_at"] for payload in payloads])
+
+        votes = {} # namespace -> key name -> list of (timestamp, payload)
+        namespace_tasks = {} # namespace -> list of tasks
+        dropped = []
+        for (task, payload, timestamp) in zip(tasks, payloads, timestamps):
+            if timestamp is None:
+                logging.warning("Dropping trending vote with invalid date: %s", payload)
+                dropped.append(task)
+                continue
+            products = votes.setdefault(payload["namespace"], {})
+            products.setdefault(payload["key_name"], []).append((timestamp, payload))
+            namespace_tasks.setdefault(payload["namespace"], []).append(task)
+        if dropped:
+            queue.delete_tasks(dropped)
+
+        # the tasks of a namespace are deleted as soon as its votes are aggregated, so a failing
+        # namespace neither blocks the others nor has its votes aggregated twice. its tasks are
+        # leased again once their lease expires
+        for (namespace, products) in votes.items():
+            try:
+                _aggregate_namespace(namespace, products)
+            except Exception:
+                logging.exception("Aggregating trending votes of namespace %r failed", namespace)
+                continue
+            queue.delete_tasks(namespace_tasks[namespace])
+            num_aggregated += sum(len(payload["user_eids"])
+                                  for votes_of_product in products.values()
+                                  for (timestamp, payload) in votes_of_product)
+
+        if len(tasks) < MAX_TASKS:
+            break
+
+    logging.info("Aggregated %d trending votes", num_aggregated)
+    return num_aggregated
+
+def _aggregate_namespace(namespace, votes):
+    previous_namespace = namespace_manager.get_namespace()
+    namespace_manager.set_namespace(namespace)
+    try:
+        key_names = votes.keys()
+        scores = TrendingScore.get_by_key_name(key_names)
+        for (index, key_name) in enumerate(key_names):
+            score = scores[index] or TrendingScore(key_name=key_name)
+            for (timestamp, payload) in sorted(votes[key_name], key=lambda vote: vote[0]):
+                for user_eid in payload["user_eids"]:
+                    score.log_score = storage.add_weights(score.log_score,
+                                                          storage.trending_weight(timestamp))
+                    score.num_votes += 1
+                    score.voters = ([user_eid] + score.voters)[:PREVIEW_SIZE]
+                score.name = payload["name"]
+            scores[index] = score
+        db.put(scores)
+
+        # as all scores decay at the same rate, only the products that were voted on can
+        # change places, so merging them into the previous top-N yields the new top-N
+        snapshot = TrendingSnapshot.get_by_key_name("trending")
+        entries = dict((entry["key"], entry)
+                       for entry in (json.loads(snapshot.entries) if snapshot else []))
+        for score in scores:
+            entries[score.key().name()] = {
+                "key": score.key().name(),
+                "name": score.name,
+                "log_score": score.log_score,
+                "num_voters": score.num_votes,
+                "voters": score.voters
+            }
+        entries = sorted(entries.values(), key=lambda entry: -entry["log_score"])[:SIZE]
+
+        TrendingSnapshot(key_name="trending",
+                         entries=json.dumps(entries),
+                         aggregated_at=time.time()).put()
+        memcache.set(CACHE_KEY, entries, time=CACHE_TIME)
+        leaderboard.bump_version()
+    finally:
+        namespace_manager.set_namespace(previous_namespace)
+
+def _parse_timestamps(datestrings):
+    """Parses ISO 8601 dates into UNIX timestamps, or None for invalid dates."""
+    try:
+        (dates, errors) = iso8601.parse_dates(datestrings)
+    except ImportError:
+        # NumPy isn't available, so the dates are parsed one by one
+        pass
+    else:
+        microseconds = dates.astype("i8")
+        return [None if index in errors else float(microseconds[index]) / 1e6
+                for index in range(len(datestrings))]
+
+    timestamps = []
+    for datestring in datestrings:
+        try:
+            date = iso8601.parse_date(datestring)
+        except iso8601.ParseError:
+            timestamps.append(None)
+            continue
+        timestamps.append(calendar.timegm(date.utctimetuple()) + date.microsecond / 1e6)
+    return timestamps
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+"""
+Write-behind buffer for votes.
+
+When enabled, votes are not written to the datastore while handling the request. Instead, they
+are added to the "votes" pull queue (see queue.yaml) and acknowledged immediately. The flush()
+function, invoked by the /tasks/flush-votes cron job, leases the buffered votes in batches,
+coalesces them per product, drops duplicate votes and writes them using counters.cast_votes().
+Every vote records the namespace it was cast in (see storage.DatastoreStorage), and is written
+to that namespace.
+
+Tasks are only deleted from the queue after their votes have been written, so if a flush fails
+the votes are leased again once the lease expires. As writing a vote is idempotent, a vote is
+never counted twice.
+
+Votes of users who already voted on the product are rejected when they're buffered, using a
+single batch get of their Vote entities. Votes that are still buffered aren't known yet, so a
+user voting twice before a flush has both votes acknowledged, while only one is counted.
+
+The number of buffered votes and the lag of the flushes are reported by stats(), which is
+included in the /_stats statistics.
+"""
+
+import json
+import logging
+import time
+
+import counters
+import leaderboard
+import models
+import trending
+
+from google.appengine.api import memcache
+from google.appengine.api import namespace_manager
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+
+QUEUE_NAME = "votes"
+
+LEASE_TIME = 60 # seconds
+
+MAX_TASKS = 1000 # the maximum number of tasks that can be leased at once
+
+MAX_TASKS_PER_ADD = 100 # the maximum number of tasks that can be added at once
+
+FLUSH_DEADLINE = 300 # seconds
+
+STATS_KEY = "votebuffer-stats"
+
+
+def add(product_name, user_eid):
+    """
+    Buffers the vote of a user on a product, in the current namespace.
+
+    @param product_name Name of the product, as entered by the user.
+    @param user_eid EID of the user casting the vote.
+
+    @return True if the vote was buffered, False if the product name is empty or the user has
+            already voted on the product.
+    """
+    return add_batch([(product_name, user_eid)])[0]
+
+def add_batch(votes):
+    """
+    Buffers multiple votes, in the current namespace.
+
+    @param votes List of (product name, user EID) tuples.
+
+    @return List containing True for every vote that was buffered, and False for every vote
+            with an empty product name, of a user who has already voted on the product, or
+            repeating an earlier vote of the list.
+
+    Existing votes are looked up using a single batch get, after which the votes are added to
+    the queue in batches of MAX_TASKS_PER_ADD.
+    """
+    namespace = namespace_manager.get_namespace()
+    now = time.time()
+
+    candidates = [] # list of (index, key name, product name, user EID)
+    seen = set()
+    for (index, (product_name, user_eid)) in enumerate(votes):
+        key_name = models.Product.key_name_for(product_name)
+        if key_name and (key_name, user_eid) not in seen:
+            seen.add((key_name, user_eid))
+            candidates.append((index, key_name, product_name, user_eid))
+    # only the keys of the products are needed, so they aren't loaded
+    existing = db.get([counters.vote_key(models.Product(key_name=key_name, name=key_name), user_eid)
+                       for (index, key_name, product_name, user_eid) in candidates])
+
+    tasks = []
+    result = [False] * len(votes)
+    for ((index, key_name, product_name, user_eid), vote) in zip(candidates, existing):
+        if vote is not None:
+            continue
+        result[index] = True
+
+        payload = {
+            "namespace": namespace,
+            "key_name": key_name,
+            "name": product_name.strip(),
+            "user_eid": user_eid,
+            "queued_at": now
+        }
+        tasks.append(taskqueue.Task(payload=json.dumps(payload), method="PULL"))
+
+    queue = taskqueue.Queue(QUEUE_NAME)
+    for offset in range(0, len(tasks), MAX_TASKS_PER_ADD):
+        queue.add(tasks[offset:offset + MAX_TASKS_PER_ADD])
+    return result
+
+def apply_pending(entries, product_name, user_eid):
+    """
+    Applies a buffered vote to ranking entries returned by leaderboard.get_top_page().
+
+    @param entries List of ranking entries. The list is modified in place.
+    @param product_name Name of the product the user voted on.
+    @param user_eid EID of the user who voted.
+
+    This way a user sees their own vote in the overview, even though it hasn't been flushed yet.
+    """
+    key_name = models.Product.key_name_for(product_name)
+    product = models.Product(key_name=key_name, name=product_name.strip())
+    if counters.has_voted(product, user_eid):
+        return
+
+    product_key = str(product.key())
+    for entry in entries:
+        if entry["key"] == product_key:
+            if user_eid not in entry["voters"]:
+                entry["num_voters"] += 1
+                if len(entry["voters"]) < counters.PREVIEW_SIZE:
+                    entry["voters"].append(user_eid)
+            break
+    else:
+        if len(entries) < leaderboard.SIZE:
+            entries.append({
+                "key": product_key,
+                "name": product.name,
+                "num_voters": 1,
+                "voters": [user_eid]
+            })
+
+def flush(index_prefixes=False):
+    """
+    Writes buffered votes to the datastore.
+
+    Keeps leasing batches of votes until the queue is drained or FLUSH_DEADLINE is exceeded.
+
+    @param index_prefixes Whether created products store the prefixes of the words of their
+           name, see storage.DatastoreStorage.
+
+    @return Dictionary with statistics about the flush, see stats().
+    """
+    queue = taskqueue.Queue(QUEUE_NAME)
+    start = time.time()
+    num_flushed = 0
+    num_counted = 0
+    max_lag = 0
+
+    while time.time() - start < FLUSH_DEADLINE:
+        tasks = queue.lease_tasks(LEASE_TIME, MAX_TASKS)
+        if not tasks:
+            break
+
+        votes = {} # namespace -> key name -> votes
+        for task in tasks:
+            vote = json.loads(task.payload)
+            # votes buffered before votes were partitioned per network have no namespace
+            products = votes.setdefault(vote.get("namespace", ""), {})
+            if vote["key_name"] not in products:
+                products[vote["key_name"]] = { "name": vote["name"], "user_eids": [], "tasks": [] }
+            products[vote["key_name"]]["user_eids"].append(vote["user_eid"])
+            products[vote["key_name"]]["tasks"].append(task)
+            max_lag = max(max_lag, time.time() - vote["queued_at"])
+
+        for (namespace, products) in votes.items():
+            (flushed, counted) = _flush_namespace(queue, namespace, products, index_prefixes)
+            num_flushed += flushed
+            num_counted += counted
+
+        if len(tasks) < MAX_TASKS:
+            break
+
+    stats = _queue_stats(queue)
+    stats.update({
+        "flushed_at": time.time(),
+        "flush_duration": time.time() - start,
+        "num_flushed": num_flushed,
+        "num_counted": num_counted,
+        "max_flush_lag": max_lag
+    })
+    memcache.set(STATS_KEY, stats)
+    logging.info("Flushed %d buffered votes (%d counted), max lag %.1fs, %d votes remaining",
+                 num_flushed, num_counted, max_lag, stats["num_pending"])
+    return stats
+
+def stats():
+    """
+    Returns statistics about the vote buffer.
+
+    @return Dictionary with the number of pending votes and the current lag of the oldest
+            pending vote in seconds, as well as the statistics of the last flush (if known):
+            the time it finished, its duration, the number of flushed and counted votes and the
+            maximum time a flushed vote spent in the buffer.
+    """
+    stats = memcache.get(STATS_KEY) or {}
+    stats.update(_queue_stats(taskqueue.Queue(QUEUE_NAME)))
+    return stats
+
+def _flush_namespace(queue, namespace, votes, index_prefixes):
+    previous_namespace = namespace_manager.get_namespace()
+    namespace_manager.set_namespace(namespace)
+    try:
+        num_flushed = 0
+        num_counted = 0
+        key_names = votes.keys()
+        products = models.Product.get_by_key_name(key_names)
+        for (key_name, product) in zip(key_names, products):
+            try:
+                if product is None:
+                    product = models.Product.get_or_insert_by_name(votes[key_name]["name"],
+                                                                   index_prefixes)
+                counted = counters.cast_votes(product, votes[key_name]["user_eids"])
+                if counted:
+                    leaderboard.record_votes(product, counted)
+                    trending.record_votes(product, counted)
+                queue.delete_tasks(votes[key_name]["tasks"])
+            except Exception, exception:
+                logging.exception(exception)
+                continue
+
+            num_flushed += len(votes[key_name]["tasks"])
+            num_counted += len(counted)
+        return (num_flushed, num_counted)
+    finally:
+        namespace_manager.set_namespace(previous_namespace)
+
+def _queue_stats(queue):
+    statistics = queue.fetch_statistics()
+    lag = 0
+    if statistics.tasks and statistics.oldest_eta_usec:
+        lag = max(0, time.time() - statistics.oldest_eta_usec / 1e6)
+    return { "num_pending": statistics.tasks, "lag": lag }